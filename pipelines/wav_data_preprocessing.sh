@@ -8,7 +8,7 @@ fi
 
 # Get the directory path from the command line argument
 in_dir_path="$1"
-out_dir_path="$1"
+out_dir_path="$2"
 
 # Check if the provided path is a valid directory
 if [ ! -d "$in_dir_path" ]; then
@@ -20,7 +20,7 @@ fi
 mkdir -p "$out_dir_path"
 
 # Check if the provided path is a valid directory and was created successfully
-if [ $? -eq 0 ]; then
+if [ $? -ne 0 ]; then
   echo "Error: '$out_dir_path' is not a valid directory."
   exit 1
 fi
@@ -28,57 +28,14 @@ fi
 # Get the directory name from the provided path
 dir_name=$(basename "$in_dir_path")
 
-# Step 1
-# Resample the audio
-mkdir -p "$out_dir_path"/resample
-python ../utils/resample_corpus.py "$in_dir_path" "$out_dir_path"/resample
+# Resample, normalize and trim the audio, file by file and in memory: every file is written once,
+# straight into the output directory, without any intermediate directory
+# WARNING! Never do a rm here as you would DELETE THE ORIGINAL DATA
+python ../utils/preprocess_corpus.py "$in_dir_path" "$out_dir_path"
 
-# Step 1 - wrap-up
-if [ $? -eq 0 ]; then
-    echo "Resampling completed successfully."
-    # WARNING! Never do a rm after the first task as you would DELETE THE ORIGINAL DATA
-else
-    echo "Error while resampling the data."
-    exit 1
-fi
-
-# Step 2
-# Normalize the audio
-mkdir -p "$out_dir_path"/resample
-python ../utils/normalize_corpus.py "$out_dir_path"/resample "$out_dir_path"/norm
-
-# Step 1 - wrap-up
-if [ $? -eq 0 ]; then
-    echo "Normalization completed successfully."
-    rm -rf "$out_dir_path"/resample
-    echo "Data from step 1 (resampling) was deleted."
-else
-    echo "Error while normalizing the data."
-    exit 1
-fi
-
-# Trim the audio
-mkdir -p "$out_dir_path"/resample
-python ../utils/trim_silence.py "$out_dir_path"/norm "$out_dir_path"/trim
-
-# Step 2 - wrap-up
-if [ $? -eq 0 ]; then
-    echo "Trimming completed successfully."
-    rm -rf "$out_dir_path"/norm
-    echo "Data from step 2 (normalization) was deleted."
-else
-    echo "Error while trimming the data."
-    exit 1
-fi
-
-# Final wrap-up
-mv "$out_dir_path"/trim/* "$out_dir_path"/
-rmdir "$out_dir_path"/trim/
-
-# Check if the symbolic link was created successfully
 if [ $? -eq 0 ]; then
   echo "Data was successfully processed and placed in directory '$out_dir_path'."
 else
-  echo "Error while deleting the final stage of intermediary data. Please check manually what happened."
+  echo "Error while processing the data."
   exit 1
-fi
\ No newline at end of file
+fi
@@ -2,12 +2,28 @@
 This module provides functions for computing cosine similarity between audio files and exporting the results to a CSV file.
 
 Functions:
+- get_default_encoder(): Returns the VoiceEncoder used by default, created on first use.
+- encoder_uses_half(model) -> bool: Returns whether the forward passes of the model run in float16.
+- encoder_autocast(model): Returns the float16 autocast context for the model on the GPUs that support it.
+- encode_partials(model, mels, batch_size): Runs the encoder on partial utterances, overlapping the copies and the forward passes on a GPU.
 - get_embedding(filepath:str, model): Computes the embedding for a given audio file using a specified model.
+- cached_preprocess_wav(filepath:str): Preprocesses an audio file like preprocess_wav, reusing the result saved by a previous run.
+- get_embeddings_batch(filepaths:list, model, batch_size, cache): Computes the embeddings of several audio files with batched forward passes.
+- embed_wavs(wavs:list, model, batch_size): Computes the embeddings of several preprocessed wavs with batched forward passes.
+- get_embeddings_cached(filepaths:list, model, embeds, cache): Computes the embeddings of the audio files that are not already in embeds.
+- load_embedding_cache(cache_file:str, model) -> dict: Loads the embeddings saved by a previous run, for the files that have not been modified since.
+- save_embedding_cache(cache_file:str, embeds:dict, model): Saves embeddings for the next runs.
+- get_reference_embedding(ref_path:str, model, type, cache, embeds): Computes the embedding of a reference file, or of all the files of a reference directory.
 - compute_cosine_similarity(x, y): Computes the cosine similarity between two embeddings.
+- batch_scores(ref, targets): Computes the cosine similarities and euclidean distances between a reference and many embeddings at once.
 - export_dict_to_csv(dictionary, csv_path): Exports a dictionary to a CSV file.
+- read_previous_rows(csv_path:str) -> list: Returns the rows written to a CSV file by a previous, possibly interrupted, run.
+- iter_audio_files(directory:str, type:str): Yields the paths of the audio files in a directory and its subdirectories, as they are found.
+- find_audio_files(directory:str, type:str) -> list: Returns the sorted paths of the audio files in a directory and its subdirectories.
 - get_audio_duration(path:str) -> int: Returns the duration of an audio file in milliseconds.
 - compute_similarity(target:str, reference:str) -> float: Computes the similarity between a target audio file and a reference audio file.
-- process_csv(ref_path, input_path, output_file, type): Processes a directory of audio files, computes the similarity for each file, and exports the results to a CSV file.
+- compute_similarity_with_ref_embed(target:str, ref_embed, model) -> float: Computes the similarity between a target audio file and a reference embedding.
+- process_csv(ref_path, input_path, output_file, type, batch_size, preprocess_cache, jobs, embedding_cache, int8, resume): Processes a directory of audio files, computes the similarity for each file, and exports the results to a CSV file.
 
 Example usage:
     python compute_cos_sim.py /path/to/reference /path/to/input /path/to/output.csv -t wav
@@ -16,18 +32,102 @@ Example usage:
 
 import os
 import csv
+import importlib.metadata
 import click
-from glob import glob
+import torch
+import numpy as np
+import soundfile as sf
 from tqdm import tqdm
 from pydub import AudioSegment
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-# The code for computing the Cosine Similarity
-from scipy.spatial.distance import cosine, euclidean
-from scipy.stats import bootstrap
+# SimSIMD is optional: its SIMD kernels compare the float16 (or int8, see quantize_embeddings) embeddings directly,
+# without converting them to float32 for NumPy
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
 
 # The resemblizer model/API
 from resemblyzer import VoiceEncoder, preprocess_wav
-speaker_encoder = VoiceEncoder()
+from resemblyzer.audio import wav_to_mel_spectrogram
+_speaker_encoder = None
+
+"""
+Returns the VoiceEncoder shared by the functions of this module, created (on the GPU if there is one) the first
+time it is needed rather than on import, so that importing the module, or starting the preprocessing worker
+processes, loads no weights and creates no CUDA context.
+
+Returns:
+   VoiceEncoder, the model, in eval mode.
+"""
+def get_default_encoder():
+    global _speaker_encoder
+    if _speaker_encoder is None:
+        _speaker_encoder = VoiceEncoder(device='cuda' if torch.cuda.is_available() else 'cpu')
+        _speaker_encoder.eval() # Set once, the model is only used for inference
+    return _speaker_encoder
+
+"""
+Returns whether the forward passes of model run in float16: on the GPUs with fast half precision (CUDA
+compute capability 5.3 and above).
+
+Arguments:
+   model (VoiceEncoder): the model.
+
+Returns:
+   bool, True if the model runs in float16, False if it runs in float32.
+"""
+def encoder_uses_half(model) -> bool:
+    return model.device.type == 'cuda' and torch.cuda.get_device_capability(model.device) >= (5, 3)
+
+"""
+Returns the context in which the forward passes of model run: float16 autocast where encoder_uses_half,
+which halves the memory traffic of the encoder, and a disabled context elsewhere.
+
+Arguments:
+   model (VoiceEncoder): the model that will be run in the context.
+
+Returns:
+   torch.autocast, the context to enter around the forward passes.
+"""
+def encoder_autocast(model):
+    return torch.autocast(device_type=model.device.type, dtype=torch.float16, enabled=encoder_uses_half(model))
+
+# Part of the name of the preprocessed wav files, to be bumped when preprocess_wav changes (e.g. resemblyzer update)
+PREPROCESS_CACHE_VERSION = 1
+# Saved with the cached embeddings, which are dropped when it changes (another resemblyzer release or another embedding),
+# followed by the precision of the forward passes
+EMBEDDING_CACHE_VERSION = "resemblyzer-" + importlib.metadata.version("resemblyzer") + "-1"
+
+"""
+Runs the encoder on partial utterances, batch_size at a time, like the forward passes of VoiceEncoder.embed_utterance.
+
+Arguments:
+   model (VoiceEncoder): the model to run.
+   mels (ndarray): the mel spectrograms of the partial utterances, shape (n_partials, n_frames, n_mels).
+   batch_size (int): the number of partial utterances in a forward pass.
+
+Returns:
+   ndarray, the float32 embeddings of the partial utterances.
+"""
+def encode_partials(model, mels:np.ndarray, batch_size:int=32) -> np.ndarray:
+    mels = torch.from_numpy(mels)
+    with encoder_autocast(model):
+        if model.device.type != 'cuda':
+            return torch.cat([model(mels[start:start + batch_size]) for start in range(0, len(mels), batch_size)]).float().numpy()
+        # The mels are copied from pinned memory by a side stream, so that the copy of a batch overlaps with the forward
+        # pass of the previous one, and the embeddings are brought back (a synchronization) only once, at the end
+        mels = mels.pin_memory()
+        copy_stream, compute_stream = torch.cuda.Stream(model.device), torch.cuda.current_stream(model.device)
+        partial_embeds = []
+        for start in range(0, len(mels), batch_size):
+            with torch.cuda.stream(copy_stream):
+                batch = mels[start:start + batch_size].to(model.device, non_blocking=True)
+            compute_stream.wait_stream(copy_stream)
+            batch.record_stream(compute_stream)
+            partial_embeds.append(model(batch))
+        return torch.cat(partial_embeds).float().cpu().numpy()
 
 """
 Computes the embedding for file filepath using model and returns it.
@@ -37,15 +137,189 @@ Arguments:
    model (VoiceEncoder): the model to use for computing the embedding. 
 
 Returns: 
-   tensor, the extracted embedding.
+   tensor, the extracted embedding, L2-normed and stored as float16 (the scores do not need more precision,
+   and half the bytes are moved around).
 """
 def get_embedding(filepath:str, model):
     ref_wav = preprocess_wav(filepath)
-    ref_embed = model.embed_utterance(ref_wav)
-    return ref_embed
+    with torch.inference_mode(), encoder_autocast(model):
+        ref_embed = model.embed_utterance(ref_wav).astype(np.float32)
+    ref_embed /= np.linalg.norm(ref_embed) + 1e-12 # Already L2-normed by resemblyzer, but the scores below rely on it
+    return ref_embed.astype(np.float16)
+
+"""
+Preprocesses an audio file like preprocess_wav (resampling, normalization, voice activity detection), and saves
+the result next to it, as filepath.pp<PREPROCESS_CACHE_VERSION>.npy. The saved wav is memory-mapped instead of
+being recomputed as long as the audio file is not modified.
+
+Arguments:
+   filepath (str): the path to the audio file to preprocess.
+
+Returns:
+   ndarray, the preprocessed float32 wav.
+"""
+def cached_preprocess_wav(filepath:str) -> np.ndarray:
+    npy_path = f"{filepath}.pp{PREPROCESS_CACHE_VERSION}.npy"
+    try:
+        if os.path.getmtime(npy_path) >= os.path.getmtime(filepath):
+            return np.load(npy_path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    wav = preprocess_wav(filepath).astype(np.float32)
+    # Written under a temporary name, so that a concurrent run never loads a partial file
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, wav)
+    os.replace(tmp_path, npy_path)
+    return wav
+
+"""
+Computes the embeddings of several audio files, like get_embedding but with the partial utterances of all
+the files going through the model together, in batches of batch_size, instead of one forward pass per file.
+
+Arguments:
+   filepaths (list): the paths to the wav files with the embeddings to compute.
+   model (VoiceEncoder): the model to use for computing the embeddings.
+   batch_size (int): the number of partial utterances in a forward pass.
+   cache (bool): whether to reuse (and save) the preprocessed wavs with cached_preprocess_wav.
+
+Returns:
+   list, the extracted embeddings, in the order of filepaths.
+"""
+def get_embeddings_batch(filepaths:list, model, batch_size:int=32, cache:bool=False) -> list:
+    # Reading and resampling the files is mostly I/O, so it is done by several threads
+    with ThreadPoolExecutor() as executor:
+        wavs = list(executor.map(cached_preprocess_wav if cache else preprocess_wav, filepaths))
+    return embed_wavs(wavs, model, batch_size)
+
+"""
+Computes the embeddings of already preprocessed wavs, with the partial utterances of all the wavs going through
+the model together, in batches of batch_size.
+
+Arguments:
+   wavs (list): the wavs returned by preprocess_wav.
+   model (VoiceEncoder): the model to use for computing the embeddings.
+   batch_size (int): the number of partial utterances in a forward pass.
+
+Returns:
+   list, the extracted embeddings, in the order of wavs.
+"""
+def embed_wavs(wavs:list, model, batch_size:int=32) -> list:
+    # Same partial utterances as VoiceEncoder.embed_utterance, but gathered from all the wavs
+    if not wavs:
+        return []
+    mels, owners = [], []
+    for i, wav in enumerate(wavs):
+        wav_slices, mel_slices = model.compute_partial_slices(len(wav), rate=1.3, min_coverage=0.75)
+        if wav_slices[-1].stop >= len(wav):
+            wav = np.pad(wav, (0, wav_slices[-1].stop - len(wav)), "constant")
+        mel = wav_to_mel_spectrogram(wav)
+        mels.extend(mel[s] for s in mel_slices)
+        owners.extend([i] * len(mel_slices))
+    mels = np.array(mels)
+
+    # No autograd context here: the callers enter torch.inference_mode() once around all the batches
+    partial_embeds = encode_partials(model, mels, batch_size)
+
+    # The embedding of a file is the L2-normed average of the embeddings of its partial utterances,
+    # which is also the L2-normed sum of these embeddings
+    raw_embeds = np.zeros((len(wavs), partial_embeds.shape[1]), dtype=partial_embeds.dtype)
+    np.add.at(raw_embeds, owners, partial_embeds)
+    return list((raw_embeds / np.linalg.norm(raw_embeds, axis=1, keepdims=True)).astype(np.float16))
+
+"""
+Computes the embeddings of several audio files like get_embeddings_batch, but only for the files that are not
+already in embeds, which gets the new embeddings.
+
+Arguments:
+   filepaths (list): the paths to the wav files with the embeddings to compute.
+   model (VoiceEncoder): the model to use for computing the embeddings.
+   embeds (dict): the embeddings already computed, by path (see load_embedding_cache), or None to compute them all.
+   cache (bool): whether to reuse (and save) the preprocessed wavs with cached_preprocess_wav.
+
+Returns:
+   list, the embeddings, in the order of filepaths.
+"""
+def get_embeddings_cached(filepaths:list, model, embeds:dict=None, cache:bool=False) -> list:
+    if embeds is None:
+        return get_embeddings_batch(filepaths, model, cache=cache)
+    new_paths = [path for path in dict.fromkeys(filepaths) if path not in embeds]
+    if new_paths:
+        embeds.update(zip(new_paths, get_embeddings_batch(new_paths, model, cache=cache)))
+    return [embeds[path] for path in filepaths]
+
+"""
+Loads the embeddings saved by save_embedding_cache. An embedding is only kept if it was computed by the same
+encoder (EMBEDDING_CACHE_VERSION) in the same precision as model and its file has not been modified since
+(same mtime and size).
+
+Arguments:
+   cache_file (str): the path to the .npz file with the embeddings, or None.
+   model (VoiceEncoder): the model that computes the other embeddings.
+
+Returns:
+   dict, the embeddings by path.
+"""
+def load_embedding_cache(cache_file:str, model) -> dict:
+    embeds = {}
+    if cache_file is None or not os.path.exists(cache_file):
+        return embeds
+    cache = np.load(cache_file)
+    if 'model' not in cache or str(cache['model']) != EMBEDDING_CACHE_VERSION + ("-fp16" if encoder_uses_half(model) else "-fp32"):
+        return embeds
+    for path, mtime, size, embed in zip(cache['paths'], cache['mtimes'], cache['sizes'], cache['embeds']):
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime_ns == mtime and stat.st_size == size:
+                embeds[str(path)] = embed
+        except FileNotFoundError:
+            pass
+    return embeds
+
+"""
+Saves embeddings, with the mtime and size of their files, for load_embedding_cache.
+
+Arguments:
+   cache_file (str): the path to the .npz file to write, or None to save nothing.
+   embeds (dict): the embeddings by path.
+   model (VoiceEncoder): the model that computed the embeddings.
+"""
+def save_embedding_cache(cache_file:str, embeds:dict, model):
+    # The files that could not be read have no embedding to save
+    embeds = {path: embed for path, embed in embeds.items() if embed is not None}
+    if cache_file is None or not embeds:
+        return
+    stats = [os.stat(path) for path in embeds]
+    # Written through a file object, as np.savez would otherwise add .npz to a cache_file without it, and load_embedding_cache would never find it
+    with open(cache_file, 'wb') as f:
+        np.savez(f, model=EMBEDDING_CACHE_VERSION + ("-fp16" if encoder_uses_half(model) else "-fp32"), paths=np.array(list(embeds.keys())),
+                 mtimes=np.array([stat.st_mtime_ns for stat in stats]), sizes=np.array([stat.st_size for stat in stats]), embeds=np.stack(list(embeds.values())))
+
+"""
+Computes the embedding of the reference: the embedding of ref_path if it is a file, or the speaker embedding
+of all the audio files in ref_path if it is a directory.
+
+Arguments:
+   ref_path (str): the path to the reference wav file or directory.
+   model (VoiceEncoder): the model to use for computing the embedding.
+   type (str): the type of audio file to look for in a reference directory.
+   cache (bool): whether to reuse (and save) the preprocessed wavs with cached_preprocess_wav.
+   embeds (dict): the embeddings already computed, by path, or None (see get_embeddings_cached).
+
+Returns:
+   tensor, the embedding of the reference.
+"""
+def get_reference_embedding(ref_path:str, model, type:str="wav", cache:bool=False, embeds:dict=None):
+    if not os.path.isdir(ref_path):
+        return get_embeddings_cached([ref_path], model, embeds, cache)[0]
+    ref_embeds = get_embeddings_cached(find_audio_files(ref_path, type), model, embeds, cache)
+    raw_embed = np.mean(ref_embeds, axis=0, dtype=np.float32)
+    return (raw_embed / np.linalg.norm(raw_embed, 2)).astype(np.float16)
 
 """
 Computes the cosine similarity between two embeddings x and y.
+If x is a matrix of embeddings (one per row), the similarities of all its rows with y are computed at once.
+The embeddings must be L2-normed, as returned by get_embedding, so that the similarity is their dot product.
 
 Arguments:
     x (tensor): the first embedding.
@@ -55,7 +329,56 @@ Returns:
     float: the cosine similarity between x and y.
 """
 def compute_cosine_similarity(x, y):
-    return 1 - cosine(x, y)
+    if np.ndim(x) == 2:
+        return batch_scores(y, x)[0]
+    if simsimd is not None:
+        return 1.0 - simsimd.cosine(x, y)
+    return float(batch_scores(y, x[None])[0][0])
+
+"""
+Quantizes embeddings to int8, each one scaled so that its largest component is 127. The cosine similarity does
+not depend on the scale of the vectors, so this uses as much of the int8 range as possible: on non-negative
+256-d embeddings such as Resemblyzer's, the cosine similarities of the quantized embeddings are within about
+3e-3 of the float ones. SimSIMD compares int8 vectors several times faster than float ones.
+
+Arguments:
+    embeds (ndarray): the embeddings, one per row, or a single embedding.
+
+Returns:
+    ndarray, the int8 embeddings.
+"""
+def quantize_embeddings(embeds:np.ndarray) -> np.ndarray:
+    embeds = embeds.astype(np.float32)
+    scales = 127 / np.maximum(np.abs(embeds).max(axis=-1, keepdims=True), np.finfo(np.float32).tiny)
+    return np.rint(embeds * scales).astype(np.int8)
+
+"""
+Computes the cosine similarities and the euclidean distances between a reference embedding and every row of
+targets. The embeddings are L2-normed, so both scores come from the dot products alone: the cosine similarity
+is the dot product and the squared euclidean distance is 2 - 2 times the dot product.
+
+Arguments:
+    ref (ndarray): the reference embedding, or one reference embedding per row of targets.
+    targets (ndarray): the embeddings to compare to the reference, one per row, of the same dtype as ref
+        (int8 embeddings from quantize_embeddings are compared by their cosine similarity).
+
+Returns:
+    tuple: the cosine similarities and the euclidean distances, one per row of targets.
+"""
+def batch_scores(ref:np.ndarray, targets:np.ndarray) -> tuple:
+    if simsimd is not None:
+        # Cosine distances of all the rows in a single call
+        distances = simsimd.cdist(ref[None], targets, metric='cosine') if ref.ndim == 1 else simsimd.cosine(ref, targets)
+        dots = 1.0 - np.asarray(distances, dtype=np.float32).reshape(-1) # float32 scores, like the NumPy path
+    else:
+        # NumPy has no float16 BLAS, so the embeddings are compared in float32
+        quantized = ref.dtype == np.int8
+        targets, ref = targets.astype(np.float32), ref.astype(np.float32)
+        dots = targets @ ref if ref.ndim == 1 else np.einsum('ij,ij->i', targets, ref)
+        if quantized:
+            # The quantized embeddings are no longer exactly L2-normed
+            dots /= np.linalg.norm(targets, axis=1) * np.linalg.norm(ref, axis=-1)
+    return dots, np.sqrt(np.maximum(2 - 2 * dots, 0)) # Rounding can make it slightly negative
 
 """
 Exports a dictionary to a CSV file.
@@ -65,7 +388,7 @@ Arguments:
     csv_path (str): the path to the CSV file to create.
 """
 def export_dict_to_csv(dictionary, csv_path):
-    with open(csv_path, 'w') as ofile:
+    with open(csv_path, 'w', newline='', buffering=1<<20) as ofile: # Written in large blocks rather than every 8 KiB
         writer = csv.writer(ofile, delimiter='\t')
         
         # Header
@@ -76,7 +399,63 @@ def export_dict_to_csv(dictionary, csv_path):
 
 
 """
-Returns the duration of an audio file in milliseconds.
+Returns the rows written to a CSV file by a previous run, without the header. The last line is left out when the
+run was interrupted before it was completely written.
+
+Arguments:
+    csv_path (str): the path to the CSV file.
+
+Returns:
+    list: the rows of the file.
+"""
+def read_previous_rows(csv_path:str) -> list:
+    with open(csv_path, newline='') as ifile:
+        lines = ifile.read().splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        lines.pop()
+    return list(csv.reader(lines[1:], delimiter='\t'))
+
+"""
+Yields the paths of the audio files in a directory and its subdirectories, like glob's '**/*.type' pattern
+(hidden files and directories are skipped) but lazily, as the directories are read, with a single os.scandir
+per directory and a suffix check.
+
+Arguments:
+    directory (str): the directory to look into.
+    type (str): the type of audio file to look for (flac, wav, etc).
+
+Yields:
+    str: the paths of the audio files, in no particular order.
+"""
+def iter_audio_files(directory:str, type:str):
+    suffix = '.' + type
+    directories = [directory]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield entry.path
+
+"""
+Returns the paths of the audio files in a directory and its subdirectories (see iter_audio_files), sorted.
+
+Arguments:
+    directory (str): the directory to look into.
+    type (str): the type of audio file to look for (flac, wav, etc).
+
+Returns:
+    list: the sorted paths of the audio files.
+"""
+def find_audio_files(directory:str, type:str) -> list:
+    return sorted(iter_audio_files(directory, type))
+
+"""
+Returns the duration of an audio file in milliseconds. It is read from the header of the file with soundfile
+(wav, flac, ...), and the file is only decoded with pydub for the formats that soundfile cannot read.
 
 Arguments:
     path (str): the path to the audio file.
@@ -85,7 +464,12 @@ Returns:
     int: the duration of the audio file in milliseconds.
 """
 def get_audio_duration(path:str) -> int:
-    # returns the duration of an audio file in ms
+    # returns the duration of an audio file in ms, rounded like len(AudioSegment)
+    try:
+        info = sf.info(path)
+        return round(1000 * info.frames / info.samplerate)
+    except RuntimeError: # Not a format libsndfile can read
+        pass
     audio = AudioSegment.from_file(path)
     return len(audio) # returns ms - use audio.duration_seconds to get the duration in seconds
 
@@ -102,41 +486,101 @@ Returns:
 def compute_similarity(target:str, reference:str) -> float:
     try:
         # Compute speaker similarity
+        speaker_encoder = get_default_encoder()
         ref_embed = get_embedding(reference, speaker_encoder)
-        cloned_embed = get_embedding(target, speaker_encoder)
-        cosine_similarity = compute_cosine_similarity(ref_embed, cloned_embed)
-        euclidean_distance = euclidean(ref_embed, cloned_embed)
+        return compute_similarity_with_ref_embed(target, ref_embed, speaker_encoder)
     except Exception as e:
         print("An exception occured:")
         exit(e)
 
+"""
+Computes the similarity between a target audio file and an already computed reference embedding, so that
+comparing many files to the same reference embeds the reference only once.
+
+Arguments:
+    target (str): the path to the target audio file.
+    ref_embed (tensor): the reference embedding, as returned by get_embedding or get_reference_embedding.
+    model (VoiceEncoder): the model to use for computing the embedding of target.
+
+Returns:
+    float: the similarity between the target audio file and the reference.
+"""
+def compute_similarity_with_ref_embed(target:str, ref_embed, model) -> float:
+    return compute_cosine_similarity(get_embedding(target, model), ref_embed)
+
 @click.command()
 @click.argument('ref_path', type=click.Path(exists=True, dir_okay=True)) 
 @click.argument('input_path', type=click.Path(exists=True, dir_okay=True)) # !!! On suppose que tous les audios sont du même système/modèle et locuteur
 @click.argument('output_file', type=click.Path(dir_okay=False))
 @click.option('-t', '--type', type=click.STRING, default="wav", help='The type of audio file to look for (flac, wav, etc).')
-def process_csv(ref_path, input_path, output_file, type):
+@click.option('-b', '--batch-size', type=click.INT, default=32, help='The number of files whose embeddings are computed together.')
+@click.option('--preprocess-cache', is_flag=True, default=False, help='Keep the preprocessed wavs next to the audio files and reuse them in the next runs.')
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of files preprocessed in parallel (defaults to the number of CPUs).')
+@click.option('--embedding-cache', type=click.Path(dir_okay=False), default=None, help='Where to keep the embeddings between runs (.npz), so that only new or modified files are embedded.')
+@click.option('--int8', is_flag=True, default=False, help='Compare the embeddings quantized to int8 (faster with SimSIMD, the similarities differ by up to about 3e-3).')
+@click.option('--resume', is_flag=True, default=False, help='Keep the rows of an existing output file (from an interrupted run) and only compute the missing files.')
+def process_csv(ref_path, input_path, output_file, type, batch_size, preprocess_cache, jobs, embedding_cache, int8, resume):
     # Check if the input is an existing path
     if not os.path.isdir(input_path):
         click.echo('Error: Input path must be an existing directory.')
         return
 
     # Check if the output file already exists
+    previous_rows = []
     if os.path.isfile(output_file):
-        click.echo('Error: Output file already exists.')
-        return
+        if not resume:
+            click.echo('Error: Output file already exists.')
+            return
+        previous_rows = read_previous_rows(output_file)
 
-    results = {}
-    for path in tqdm(sorted(glob(os.path.join(input_path, '**/*.'+type), recursive=True))):
-        duration = get_audio_duration(path)
-        similarity = compute_similarity(path, reference)
-        results[path] = [duration, similarity]
-
-    # Perform operations on the CSV file and generate output
+    done = {row[0] for row in previous_rows}
+    paths = [path for path in find_audio_files(input_path, type) if path not in done]
+    # The rows are written as soon as their batch is scored, so that nothing but the current batch is kept in memory
+    # and the rows already written survive an interruption
     click.echo(f'Generating output file: {output_file}...\r')
-    export_dict_to_csv(results, output_file)
+    with open(output_file, 'w', newline='', buffering=1<<20) as ofile:
+        writer = csv.writer(ofile, delimiter='\t')
+        writer.writerow(["Path", "Duration", "MOS"])
+        writer.writerows(previous_rows) # Written again rather than appended to, to drop a line cut short by an interruption
+
+        # At most one refresh per second, the batches can go by faster than the terminal is worth updating
+        with tqdm(total=len(paths), desc="Calculating similarity", mininterval=1.0, miniters=max(1, len(paths)//500), smoothing=0.05) as progress_bar, torch.inference_mode():
+            try:
+                # The reference embedding is computed once, instead of once per file
+                speaker_encoder = get_default_encoder()
+                embeds = load_embedding_cache(embedding_cache, speaker_encoder)
+                ref_embed = get_reference_embedding(ref_path, speaker_encoder, type, preprocess_cache, embeds)
+                # Only the compared copies are quantized, the cached embeddings stay float16
+                to_compared = quantize_embeddings if int8 else (lambda embeds: embeds)
+                ref_embed = to_compared(ref_embed)
+                batches = [paths[start:start + batch_size] for start in range(0, len(paths), batch_size)]
+                # Only the files without an embedding from a previous run go through the model
+                new_batches = [[path for path in batch if path not in embeds] for batch in batches]
+                preprocess = cached_preprocess_wav if preprocess_cache else preprocess_wav
+                # Resampling and voice activity detection are CPU bound, so they run in worker processes, unless the model
+                # is on a GPU (CUDA cannot be used in forked processes)
+                executor_class = ProcessPoolExecutor if speaker_encoder.device.type == 'cpu' else ThreadPoolExecutor
+                with executor_class(max_workers=jobs) as executor:
+                    # The files of the next batch are preprocessed while the model embeds the current one,
+                    # so that the model does not wait for the files to be read
+                    next_wavs = executor.map(preprocess, new_batches[0]) if batches else None
+                    for i, (batch, new_batch) in enumerate(zip(batches, new_batches)):
+                        wavs = list(next_wavs)
+                        if i + 1 < len(batches):
+                            next_wavs = executor.map(preprocess, new_batches[i + 1])
+                        new_embeds = dict(zip(new_batch, embed_wavs(wavs, speaker_encoder, batch_size))) if new_batch else {}
+                        similarities = compute_cosine_similarity(to_compared(np.stack([new_embeds[path] if path in new_embeds else embeds[path] for path in batch])), ref_embed)
+                        writer.writerows((path, get_audio_duration(path), similarity) for path, similarity in zip(batch, similarities))
+                        ofile.flush()
+                        if embedding_cache is not None:
+                            embeds.update(new_embeds)
+                        progress_bar.update(len(batch))
+            except Exception as e:
+                print("An exception occured:")
+                exit(e)
+
+    save_embedding_cache(embedding_cache, embeds, speaker_encoder)
     click.echo("done.")
 
 if __name__ == '__main__':
     process_csv()
-
@@ -1,35 +1,107 @@
 import os
 import csv
-from glob import glob
+import contextlib
 from tqdm import tqdm
+import soundfile as sf
 from pydub import AudioSegment
+from concurrent.futures import ThreadPoolExecutor
 
+import torch
+import librosa
 from wvmos import get_wvmos
 model = get_wvmos(cuda=True) # Update if necessary
+model.eval()
 
 import click
 import os
 
-def export_dict_to_csv(dictionary, csv_path):
-    with open(csv_path, 'w') as ofile:
+def write_csv(rows, csv_path):
+    with open(csv_path, 'w', newline='') as ofile:
         writer = csv.writer(ofile, delimiter='\t')
         
         # Header
         writer.writerow(["Path", "Duration", "MOS"])
         
-        for key, value in dictionary.items():
-            writer.writerow([key, value[0], value[1]])
+        writer.writerows(rows)
+
+def read_previous_rows(csv_path:str) -> list:
+    # The rows written by a previous run, without the header. The last line is left out when the run was interrupted
+    # before it was completely written
+    with open(csv_path, newline='') as ifile:
+        lines = ifile.read().splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        lines.pop()
+    return list(csv.reader(lines[1:], delimiter='\t'))
+
+def iter_audio_files(directory:str, type:str):
+    # Same files as glob's '**/*.type' pattern (hidden files and directories are skipped), yielded as the
+    # directories are read, with a single os.scandir per directory and a suffix check instead of fnmatch
+    suffix = '.' + type
+    directories = [directory]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield entry.path
 
 def get_audio_duration(path:str) -> int:
-    # returns the duration of an audio file in ms
+    # returns the duration of an audio file in ms, rounded like len(AudioSegment)
+    # It is read from the header when soundfile can read the format, instead of decoding the whole file
+    try:
+        info = sf.info(path)
+        return round(1000 * info.frames / info.samplerate)
+    except RuntimeError: # Not a format libsndfile can read
+        pass
     audio = AudioSegment.from_file(path)
     return len(audio) # returns ms - use audio.duration_seconds to get the duration in seconds
 
+def bucket_by_duration(paths:list, durations:dict, batch_size:int) -> list:
+    # Sorting by duration means that each batch only holds files of similar lengths,
+    # so that padding every file to the longest one of its batch wastes as little compute as possible
+    paths = sorted(paths, key=lambda path: durations[path])
+    return [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+
+def load_wavs(paths:list) -> list:
+    # Same decoding as model.calculate_one
+    return [librosa.load(path, sr=16_000)[0] for path in paths]
+
+def mos_autocast(fp16:bool):
+    # Half precision (tensor cores) on the GPU when asked for, the scores then slightly differ
+    return torch.autocast("cuda", dtype=torch.float16) if fp16 and model.cuda_flag else contextlib.nullcontext()
+
+def calculate_batch(wavs:list, fp16:bool=False) -> list:
+    if len(wavs) == 1:
+        # Same computation as model.calculate_one, on an already loaded waveform
+        x = model.processor(wavs[0], return_tensors="pt", padding=True, sampling_rate=16000).input_values
+        with torch.inference_mode(), mos_autocast(fp16):
+            if model.cuda_flag:
+                x = x.cuda()
+            return [model(x).float().mean().cpu().item()]
+
+    # Batched version of model.calculate_one: the waveforms are zero-padded to the longest one of the batch
+    # and the padded frames are left out of the average so that every file keeps its own score
+    x = model.processor(wavs, return_tensors="pt", padding=True, sampling_rate=16000).input_values
+    with torch.inference_mode(), mos_autocast(fp16):
+        if model.cuda_flag:
+            x = x.cuda()
+        frame_scores = model.dense(model.encoder(x)['last_hidden_state'])[..., 0].float() # [batch, time]
+        n_frames = model.encoder._get_feat_extract_output_lengths(torch.tensor([len(wav) for wav in wavs], device=x.device))
+        mask = torch.arange(frame_scores.shape[1], device=x.device)[None, :] < n_frames[:, None]
+        res = (frame_scores * mask).sum(dim=1) / n_frames
+    return res.cpu().tolist()
+
 @click.command()
 @click.argument('input_path', type=click.Path(exists=True, dir_okay=True))
 @click.argument('output_file', type=click.Path(dir_okay=False))
 @click.option('-t', '--type', type=click.STRING, default="wav", help='The type of audio file to look for (flac, wav, etc).')
-def process_csv(input_path, output_file, type):
+@click.option('-b', '--batch-size', type=click.INT, default=1, help='The number of files to score at once. Files are grouped by duration to limit padding, but scores may slightly differ from the ones computed one file at a time.')
+@click.option('--fp16', is_flag=True, default=False, help='Run the model in half precision on the GPU (faster, but the scores slightly differ).')
+@click.option('--resume', is_flag=True, default=False, help='Keep the rows of an existing output file (from an interrupted run) and only score the missing files.')
+def process_csv(input_path, output_file, type, batch_size, fp16, resume):
 
     # Check if the input is an existing path
     if not os.path.isdir(input_path):
@@ -37,21 +109,47 @@ def process_csv(input_path, output_file, type):
         return
 
     # Check if the output file already exists
+    previous_rows = []
     if os.path.isfile(output_file):
-        click.echo('Error: Output file already exists.')
-        return
+        if not resume:
+            click.echo('Error: Output file already exists.')
+            return
+        previous_rows = read_previous_rows(output_file)
+
+    done = {row[0] for row in previous_rows}
+    paths = [path for path in sorted(iter_audio_files(input_path, type)) if path not in done]
+    # The progress bars refresh at most once per second: reading a header takes far less time than a terminal update
+    durations = {path: get_audio_duration(path) for path in tqdm(paths, desc="Reading durations", mininterval=1.0, miniters=max(1, len(paths)//500))}
 
-    results = {}
-    for path in tqdm(sorted(glob(os.path.join(input_path, '**/*.'+type), recursive=True))):
-        duration = get_audio_duration(path)
-        mos = model.calculate_one(path)
-        results[path] = [duration, mos]
+    rows = list(previous_rows)
+    batches = bucket_by_duration(paths, durations, batch_size)
+    # The rows are also written as soon as their batch is scored, so that an interrupted run can be resumed
+    # from the rows already written
+    with open(output_file, 'w', newline='') as ofile:
+        writer = csv.writer(ofile, delimiter='\t')
+        writer.writerow(["Path", "Duration", "MOS"])
+        writer.writerows(previous_rows) # Written again rather than appended to, to drop a line cut short by an interruption
+
+        # The next batch is decoded by a thread while the model scores the current one (decoding mostly releases the GIL)
+        with tqdm(total=len(paths), desc="Computing MOS", mininterval=1.0) as pbar, ThreadPoolExecutor(max_workers=1) as executor:
+            next_wavs = executor.submit(load_wavs, batches[0]) if batches else None
+            for i, batch in enumerate(batches):
+                wavs = next_wavs.result()
+                if i + 1 < len(batches):
+                    next_wavs = executor.submit(load_wavs, batches[i + 1])
+                batch_rows = [[path, durations[path], score] for path, score in zip(batch, calculate_batch(wavs, fp16))]
+                writer.writerows(batch_rows)
+                ofile.flush()
+                rows.extend(batch_rows)
+                pbar.update(len(batch))
+
+    # The results are written again in the original (path) order, not in the order they were computed in
+    rows.sort(key=lambda row: row[0])
 
     # Perform operations on the CSV file and generate output
     click.echo(f'Generating output file: {output_file}...\r')
-    export_dict_to_csv(results, output_file)
+    write_csv(rows, output_file)
     click.echo("done.")
 
 if __name__ == '__main__':
     process_csv()
-
@@ -2,20 +2,40 @@ import csv
 import os
 import click
 import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-def copy_files_from_tsv(tsv_file, output_directory):
+def copy_file(path, dst_path, link=False):
+    if os.path.exists(dst_path) and os.path.samefile(path, dst_path):
+        return # Already there (the output directory is the source one, or the file was linked by an earlier run)
+    if link:
+        # A hard link shares the data of the source file: nothing is copied, but editing one edits the other.
+        # It is made under a temporary name then moved over dst_path, so an existing file is only replaced once its replacement exists
+        tmp_path = f"{dst_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            pass # Another filesystem (or no hard links on this one): the file is copied
+        else:
+            os.replace(tmp_path, dst_path)
+            return
+    # Only the content is copied, not the permission bits as shutil.copy does (copyfile uses sendfile on Linux)
+    shutil.copyfile(path, dst_path)
+
+def copy_files_from_tsv(tsv_file, output_directory, link=False, jobs=8):
     try:
         with open(tsv_file, 'r', newline='') as tsvfile:
             reader = csv.DictReader(tsvfile, delimiter='\t', quotechar='|')
-            for row in reader:
-                # Get the path from the "Basename" column
-                path = row.get('Basename')
-                if path:
-                    # Check if the source file exists
-                    if os.path.exists(path):
-                        # Copy the file to the specified output directory
-                        shutil.copy(path, os.path.join(output_directory, os.path.basename(path)))
-                        print(f"Copied: {path} to {output_directory}")
+            # Get the path from the "Basename" column, and check if the source file exists
+            paths = [path for path in (row.get('Basename') for row in reader) if path and os.path.exists(path)]
+
+        # Copy the files to the specified output directory. Copies mostly wait for the disk, so several are run at once by threads
+        # Rows with the same file name would be written to the same file by two threads at once: the last one wins, as when they were copied in order
+        sources = {os.path.join(output_directory, os.path.basename(path)): path for path in paths}
+        paths, dst_paths = list(sources.values()), list(sources)
+        with ThreadPoolExecutor(jobs) as executor:
+            for path, _ in zip(paths, executor.map(copy_file, paths, dst_paths, [link] * len(paths))):
+                print(f"Copied: {path} to {output_directory}")
 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -23,8 +43,10 @@ def copy_files_from_tsv(tsv_file, output_directory):
 @click.command()
 @click.argument('tsv_file', type=click.Path(exists=True))
 @click.argument('output_directory', type=click.Path())
-def process_tsv(tsv_file, output_directory):
-    copy_files_from_tsv(tsv_file, output_directory)
+@click.option('--link', is_flag=True, default=False, help='Hard link the files instead of copying them when they are on the same filesystem as the output directory (the linked files share their content with the original ones).')
+@click.option('-j', '--jobs', type=click.INT, default=8, help='The number of files copied at once.')
+def process_tsv(tsv_file, output_directory, link, jobs):
+    copy_files_from_tsv(tsv_file, output_directory, link, jobs)
     print("File copy completed.")
 
 if __name__ == '__main__':
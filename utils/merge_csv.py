@@ -1,5 +1,7 @@
 import csv
+import os
 import click
+import itertools
 
 def resolve_header(colonne_cle:str, header1:str, header2:str) -> tuple[int, int]:
     h1 = h2 = -1
@@ -11,7 +13,7 @@ def resolve_header(colonne_cle:str, header1:str, header2:str) -> tuple[int, int]
     for i, h in enumerate(header2):
         if h == colonne_cle:
             h2 = i
-    if h1 == -1:
+    if h2 == -1:
         exit(f"Error: couldn't find column \"{colonne_cle}\" in the second CSV. Please check.")
         
     return h1,h2
@@ -31,38 +33,39 @@ def main(fichier_csv1, fichier_csv2, colonne_cle, output):
         colonne_cle: Le nom de la colonne commune entre les deux fichiers.
     """
 
-    with open(fichier_csv1, "r") as f1:
-        reader1 = csv.reader(f1, delimiter="\t", quotechar='|')
-        lignes1 = list(reader1)
-
     with open(fichier_csv2, "r") as f2:
         reader2 = csv.reader(f2, delimiter="\t", quotechar='|')
         lignes2 = list(reader2)
-    
-    key1, key2 = resolve_header(colonne_cle, lignes1[0], lignes2[0])
 
-    # Crée un dictionnaire qui mappe les lignes du premier fichier CSV sur les lignes du deuxième fichier CSV
-    # en se basant sur la colonne clé
-    resulting_data = []
-    match = 0
-    for ligne1 in lignes1:
-        for ligne2 in lignes2:            
-            if ligne1[key1] == ligne2[key2]:
-                print(f"Found a match: {ligne1} --- \t --- {ligne2}")
-                match+=1
-                tmp = ligne2
-                del tmp[key2]
-                resulting_data.append(ligne1 + tmp)
-                break
-            
+    # The first CSV is read, merged and written line by line; only the second one is held in memory.
+    # The lines are written to a temporary file that replaces the output once complete, so the output may be one of the inputs
+    tmp_output = output + ".tmp"
+    with open(fichier_csv1, "r") as f1:
+        reader1 = csv.reader(f1, delimiter="\t", quotechar='|')
+        header1 = next(reader1)
+        key1, key2 = resolve_header(colonne_cle, header1, lignes2[0])
+
+        # Crée un dictionnaire qui mappe les valeurs de la colonne clé sur les lignes du deuxième fichier CSV
+        # (la première ligne pour une valeur donnée), pour ne pas parcourir tout le deuxième fichier à chaque ligne
+        lignes2_par_cle = {}
+        for ligne2 in lignes2:
+            lignes2_par_cle.setdefault(ligne2[key2], ligne2)
+
+        # Écrit les lignes fusionnées dans un nouveau fichier CSV
+        with open(tmp_output, "w") as f:
+            writer = csv.writer(f, delimiter="\t", quotechar='|')
+            match = 0
+            for ligne1 in itertools.chain([header1], reader1):
+                ligne2 = lignes2_par_cle.get(ligne1[key1])
+                if ligne2 is not None:
+                    print(f"Found a match: {ligne1} --- \t --- {ligne2}")
+                    match+=1
+                    writer.writerow(ligne1 + ligne2[:key2] + ligne2[key2 + 1:])
+    os.replace(tmp_output, output)
+
     if match != len(lignes2):
         print(f"Found {match} matching lines but {fichier_csv2} is {len(lignes2)} lines long.")
 
-    # Écrit les lignes fusionnées dans un nouveau fichier CSV
-    with open(output, "w") as f:
-        writer = csv.writer(f, delimiter="\t", quotechar='|')
-        writer.writerows(resulting_data)
-
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,18 @@
 import os
+import math
+import wave
+import shutil
+import functools
+import itertools
 import click
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor
 from pydub import AudioSegment
+try:
+    import pyloudnorm as pyln
+except ImportError:
+    pyln = None
 
 class NegativeNumberParamType(click.ParamType):
     name = 'negative_numbers_only'
@@ -8,41 +20,179 @@ class NegativeNumberParamType(click.ParamType):
     def convert(self, value, param, ctx):
         try:
             number = float(value)
-            if number < 0:
-                return number
-            else:
-                self.fail(f'{value} is not a negative number. Values passed in dB LUFS cannot be positive.', param, ctx)
         except ValueError:
             self.fail(f'{value} is not a valid number. Values passed in dB LUFS should be, well... numerical values.', param, ctx)
+        if number >= 0:
+            self.fail(f'{value} is not a negative number. Values passed in dB LUFS cannot be positive.', param, ctx)
+        return number
 
-def normalize_audio(src_dir:str, dst_dir:str, target_loudness:int):
+def loudness_gain(rms:int, max_amplitude:int, target_loudness:int, tolerance:float=0.0) -> float:
+    # The factor to multiply the samples by to reach the target loudness, computed as pydub does, or None
+    # when the samples are left as they are
+    loudness = 20 * math.log(rms / max_amplitude, 10) if rms else -float("infinity")
+    target_lufs = target_loudness  # Target LUFS level
+
+    if rms and abs(loudness - target_lufs) < tolerance:
+        return None # Already normalized
+
+    if loudness != target_lufs:
+        # Calculate the gain required to reach the target LUFS level, a silent file is left as is
+        gain = target_lufs - loudness
+        return 10 ** (gain / 20) if rms else None
+    print(f"WARNING ! Fould a strange loudness figure ({loudness}) or current loudness == target.")
+    return None
+
+def apply_gain(samples:np.ndarray, factor:float, max_amplitude:int) -> np.ndarray:
+    # Same rounding as audioop.mul: the gained samples are floored and clipped
+    return np.clip(np.floor(samples * factor), -max_amplitude, max_amplitude - 1).astype(samples.dtype)
+
+def sum_of_squares(samples:np.ndarray, block_size:int=1 << 20):
+    # Without a float64 copy of the samples: einsum squares and sums samples of up to 16 bits in int64 (exact),
+    # wider samples, whose squares could overflow int64, are converted and summed in float64 a block at a time
+    flat_samples = samples.reshape(-1)
+    if flat_samples.itemsize <= 2:
+        return int(np.einsum('i,i->', flat_samples, flat_samples, dtype=np.int64))
+    blocks = (flat_samples[start:start + block_size].astype(np.float64) for start in range(0, flat_samples.size, block_size))
+    return sum(float(np.dot(block, block)) for block in blocks)
+
+def normalize_samples(samples:np.ndarray, max_amplitude:int, target_loudness:int, tolerance:float=0.0) -> np.ndarray:
+    # Same loudness and gain computations as pydub (audioop.rms and audioop.mul), done with vectorized NumPy
+    # operations. The very same array is returned when nothing changes
+    rms = int(math.sqrt(sum_of_squares(samples) / samples.size)) if samples.size else 0
+    factor = loudness_gain(rms, max_amplitude, target_loudness, tolerance)
+    return samples if factor is None else apply_gain(samples, factor, max_amplitude)
+
+STREAMING_MIN_DURATION = 600 # 16 bit files longer than this (in seconds) are normalized block by block instead of being loaded whole
+
+def normalize_pcm16_file_streaming(src_file_path:str, dst_file_path:str, target_loudness:int, tolerance:float=0.0, block_frames:int=1 << 16):
+    # Normalizes a long file in two passes over blocks of samples, the loudness of the whole file then the gain,
+    # so that only a block is in memory at a time. Same result as normalize_samples
+    with open(src_file_path, 'rb') as raw_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(raw_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL) # Larger readahead for the two sequential reads
+        with sf.SoundFile(raw_file) as src:
+            sum_squares, n_samples = 0, 0
+            for block in src.blocks(block_frames, dtype='int16'):
+                sum_squares += sum_of_squares(block)
+                n_samples += block.size
+            rms = int(math.sqrt(sum_squares / n_samples)) if n_samples else 0
+            factor = loudness_gain(rms, 2 ** 15, target_loudness, tolerance)
+            if factor is None and src.format == 'WAV':
+                shutil.copyfile(src_file_path, dst_file_path) # Nothing changed, the file is copied rather than encoded again
+                return
+
+            src.seek(0)
+            with sf.SoundFile(dst_file_path, 'w', src.samplerate, src.channels, 'PCM_16', format='WAV') as dst:
+                for block in src.blocks(block_frames, dtype='int16'):
+                    dst.write(block if factor is None else apply_gain(block, factor, 2 ** 15))
+
+@functools.lru_cache(maxsize=None)
+def get_meter(frame_rate:int):
+    # One BS.1770 meter per frame rate, as building its K-weighting filters is not free
+    return pyln.Meter(frame_rate)
+
+def normalize_lufs_file(src_file_path:str, dst_file_path:str, target_loudness:int):
+    # Integrated loudness (ITU-R BS.1770) rather than the RMS level of the samples, measured and applied by pyloudnorm
+    samples, frame_rate = sf.read(src_file_path)
+    try:
+        loudness = get_meter(frame_rate).integrated_loudness(samples)
+    except ValueError:
+        loudness = None # Shorter than the 400ms gating block of the meter
+    if loudness is not None and np.isfinite(loudness) and loudness != target_loudness:
+        samples = pyln.normalize.loudness(samples, loudness, target_loudness)
+    else:
+        print(f"WARNING ! Fould a strange loudness figure ({loudness}) or current loudness == target.")
+    sf.write(dst_file_path, samples, frame_rate, 'PCM_16')
+
+def prefetch_file(file_path:str):
+    # Asks the kernel to start reading the file in the background, so that it is in the page cache by the time
+    # it is decoded (POSIX only, a no-op elsewhere)
+    if file_path is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def write_wav(file_path:str, samples:np.ndarray, channels:int, frame_rate:int):
+    # Writes the same file as AudioSegment.export(format="wav") with the wave module, straight from the samples,
+    # without building a new AudioSegment. As in pydub, 8 bit samples are stored unsigned
+    data = (samples.view(np.uint8) + np.uint8(128)) if samples.dtype.itemsize == 1 else samples
+    with wave.open(file_path, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(samples.dtype.itemsize)
+        wav_file.setframerate(frame_rate)
+        wav_file.writeframes(data.tobytes())
+
+def normalize_file(src_file_path:str, dst_file_path:str, target_loudness:int, measure:str="dbfs", tolerance:float=0.0, next_src_file_path:str=None):
+    prefetch_file(next_src_file_path) # The next file of the same worker is read from the disk while this one is normalized
+    if measure == "lufs":
+        return normalize_lufs_file(src_file_path, dst_file_path, target_loudness)
+
+    try:
+        info = sf.info(src_file_path)
+    except RuntimeError:
+        info = None # Not readable by soundfile, left to pydub
+    if info is not None and info.subtype == 'PCM_16' and info.duration > STREAMING_MIN_DURATION:
+        return normalize_pcm16_file_streaming(src_file_path, dst_file_path, target_loudness, tolerance)
+    if info is not None and info.subtype == 'PCM_16':
+        # 16 bit PCM wav files are read and written by soundfile, without the AudioSegment copies
+        samples, frame_rate = sf.read(src_file_path, dtype='int16')
+        normalized = normalize_samples(samples, 2 ** 15, target_loudness, tolerance)
+        if normalized is samples and info.format == 'WAV':
+            shutil.copyfile(src_file_path, dst_file_path) # Nothing changed, the file is copied rather than encoded again
+        else:
+            sf.write(dst_file_path, normalized, frame_rate, 'PCM_16')
+        return
+
+    # Load the audio file and normalize to -23dB LUFS
+    audio = AudioSegment.from_file(src_file_path)
+    samples = np.frombuffer(audio.raw_data, dtype=audio.array_type)
+    samples = normalize_samples(samples, audio.max_possible_amplitude, target_loudness, tolerance)
+
+    # Export the normalized audio to the target directory
+    write_wav(dst_file_path, samples, audio.channels, audio.frame_rate)
+
+def walk_wav_files(src_dir:str):
+    # Lazily yields the wav files below src_dir. os.scandir entries already know whether they are directories,
+    # so nothing is stat'ed again as os.walk does
+    pending_dirs = [src_dir]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.name.endswith(".wav"):
+                    yield entry.path
+
+def normalize_audio(src_dir:str, dst_dir:str, target_loudness:int, jobs:int=None, measure:str="dbfs", tolerance:float=0.0):
+    if measure == "lufs" and pyln is None:
+        print("Error: pyloudnorm must be installed to normalize the integrated loudness (pip install pyloudnorm).")
+        return
     try:
         # Recursively create the same directory structure in the target directory
-        for root, _, files in os.walk(src_dir):
-            for file in files:
-                if not file.endswith(".wav"):
-                    continue
-                src_file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(src_file_path, src_dir)
-                dst_file_path = os.path.join(dst_dir, relative_path)
-
-                # Create the target directory if it doesn't exist
-                os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
-
-                # Load the audio file and normalize to -23dB LUFS
-                audio = AudioSegment.from_file(src_file_path)
-                loudness = audio.dBFS
-                target_lufs = target_loudness  # Target LUFS level
-
-                if loudness is not None and loudness != target_lufs:
-                    # Calculate the gain required to reach the target LUFS level
-                    gain = target_lufs - loudness
-                    audio = audio + gain  # Apply the gain to normalize
-                else: 
-                    print(f"WARNING ! Fould a strange loudness figure ({loudness}) or current loudness == target.")
-
-                # Export the normalized audio to the target directory
-                audio.export(dst_file_path, format="wav")
+        src_file_paths, dst_file_paths, created_dirs = [], [], set()
+        prefix_length = len(os.path.join(src_dir, "")) # Relative paths are sliced out rather than computed by os.path.relpath
+        for src_file_path in walk_wav_files(src_dir):
+            dst_file_path = os.path.join(dst_dir, src_file_path[prefix_length:])
+
+            # Create the target directory if it doesn't exist, once per directory and here rather than in the workers,
+            # which would race
+            dst_file_dir = os.path.dirname(dst_file_path)
+            if dst_file_dir not in created_dirs:
+                os.makedirs(dst_file_dir, exist_ok=True)
+                created_dirs.add(dst_file_dir)
+            src_file_paths.append(src_file_path)
+            dst_file_paths.append(dst_file_path)
+
+        # The files are independent, so they are normalized by a pool of processes
+        with ProcessPoolExecutor(jobs) as executor:
+            for _ in executor.map(normalize_file, src_file_paths, dst_file_paths, itertools.repeat(target_loudness), itertools.repeat(measure), itertools.repeat(tolerance), src_file_paths[1:] + [None], chunksize=16):
+                pass
 
         print(f"Directory structure replicated and audio files normalized from '{src_dir}' to '{dst_dir}'.")
         print("WARNING ! Although the directory structure was copied, ONLY THE WAV FILES were copied.")
@@ -53,8 +203,11 @@ def normalize_audio(src_dir:str, dst_dir:str, target_loudness:int):
 @click.argument('src_directory', type=click.Path(exists=True))
 @click.argument('dst_directory', type=click.Path())
 @click.option('--db', type=NegativeNumberParamType(), default=-23, help='The desired loudness in dB LUFS (Loudness Units Full Scale).')
-def normalize_and_replicate(src_directory, dst_directory, db):
-    normalize_audio(src_directory, dst_directory, db)
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of processes normalizing the files (defaults to the number of CPUs).')
+@click.option('--measure', type=click.Choice(["dbfs", "lufs"]), default="dbfs", help='Normalize the RMS level of the samples (dBFS) or their integrated loudness as defined by ITU-R BS.1770 (LUFS, needs pyloudnorm).')
+@click.option('--tolerance', type=click.FLOAT, default=0.0, help='The files already within this many dB of the target loudness are copied as they are (dBFS only, 0 normalizes every file).')
+def normalize_and_replicate(src_directory, dst_directory, db, jobs, measure, tolerance):
+    normalize_audio(src_directory, dst_directory, db, jobs, measure, tolerance)
 
 if __name__ == '__main__':
     normalize_and_replicate()
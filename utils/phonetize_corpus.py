@@ -1,17 +1,116 @@
+import os
+import csv
+import collections
+import contextlib
+import functools
+import threading
 import click
 import pandas as pd
 from phonemizer import phonemize
 from phonemizer.backend import EspeakBackend
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_csv = pq = None
 
 CHOICES = {"english":"en-us", "french":"fr-fr", "german":"de", "portuguese":"pt", "polish":"pl", "dutch":"nl", "spanish":"es", "italian":"it"}
+LANG_CODES = frozenset(CHOICES.values())
 
+@functools.lru_cache(maxsize=256)
 def get_lang_code(text:str) -> str:
     for choice, lg in CHOICES.items():
         if choice in text:
             return lg
     exit(f"ERROR: String {text} must match one of the following choices: {CHOICES}")
-    
+
+# Creating a backend is slow, so each one is created on first use and kept for the next calls. The lock keeps
+# two threads from creating the same backend
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(language:str) -> EspeakBackend:
+    with _backends_lock:
+        if language not in _backends:
+            if language not in LANG_CODES:
+                exit(f"Got an unexpected language code: {language}")
+            _backends[language] = EspeakBackend(language, preserve_punctuation=True)
+        return _backends[language]
+
+# Bound on the number of phonemized transcripts kept by phonemize_by_language, per language
+MAX_CACHED_TRANSCRIPTS = 1_000_000
+
+def phonemize_chunk(language:str, chunk:list) -> list:
+    # Runs in the worker processes, which each create their own backends through get_backend
+    backend = get_backend(language)
+    try:
+        return backend.phonemize(chunk)
+    except Exception:
+        # Phonemized one by one, so that only the faulty transcripts are left empty
+        chunk_ipa_strings = []
+        for transcript in chunk:
+            try:
+                chunk_ipa_strings.append(backend.phonemize([transcript])[0])
+            except Exception as e:
+                print(f"Could not phonemize {transcript=}: {e}")
+                chunk_ipa_strings.append("")
+        return chunk_ipa_strings
+
+def phonemize_by_language(transcripts:list, languages:list, chunk_size:int, executor, progress_bar, cache:dict) -> list:
+    # The transcripts are phonemized by language, a chunk at a time: each call to the backend has a fixed cost,
+    # which is paid once per chunk instead of once per line. The chunks of all the languages are phonemized
+    # by the processes of executor when it is given.
+    # A transcript already phonemized (in this call or a previous one, as kept in cache) is not phonemized again
+    chunks = []
+    for language in dict.fromkeys(languages):
+        if language not in LANG_CODES:
+            exit(f"Got an unexpected language code: {language}")
+        language_cache = cache.setdefault(language, {})
+        if len(language_cache) > MAX_CACHED_TRANSCRIPTS:
+            language_cache.clear()
+        language_cache[""] = "" # The phonemizer drops empty lines, which would shift the phonetizations of a chunk
+        new_transcripts = list(dict.fromkeys(transcript for transcript, line_language in zip(transcripts, languages) if line_language == language and transcript not in language_cache))
+        chunks.extend((language, new_transcripts[start:start + chunk_size]) for start in range(0, len(new_transcripts), chunk_size))
+
+    chunk_languages = [language for language, _ in chunks]
+    chunk_transcripts = [chunk for _, chunk in chunks]
+    results = executor.map(phonemize_chunk, chunk_languages, chunk_transcripts) if executor else map(phonemize_chunk, chunk_languages, chunk_transcripts)
+    for language, chunk, chunk_ipa_strings in zip(chunk_languages, chunk_transcripts, results):
+        cache[language].update(zip(chunk, chunk_ipa_strings))
+        progress_bar.update(len(chunk))
+    progress_bar.update(len(transcripts) - sum(len(chunk) for chunk in chunk_transcripts)) # The lines that were already phonemized
+    return [cache[language][transcript] for transcript, language in zip(transcripts, languages)]
+
+def iter_csv_blocks(input_csv_file, columns:list, separator:str, quotechar:str, read_size:int, engine:str):
+    # Yields the CSV file as DataFrames of at most read_size lines. The pyarrow reader tokenizes the file with
+    # several threads and only converts the columns used, read as strings; pandas' chunked reader is used when
+    # it is not installed
+    if engine == 'pyarrow' and pa_csv is not None:
+        reader = pa_csv.open_csv(input_csv_file.buffer,
+                                 read_options=pa_csv.ReadOptions(block_size=8 << 20),
+                                 parse_options=pa_csv.ParseOptions(delimiter=separator, quote_char=quotechar, newlines_in_values=True), # Quoted newlines, as pandas accepts them
+                                 convert_options=pa_csv.ConvertOptions(include_columns=columns, column_types={column: pa.string() for column in columns}, strings_can_be_null=False))
+        for batch in reader:
+            for start in range(0, batch.num_rows, read_size):
+                yield batch.slice(start, read_size).to_pandas()
+    else:
+        yield from pd.read_csv(input_csv_file, sep=separator, quotechar=quotechar, chunksize=read_size)
+
+OUTPUT_COLUMNS = ['Basename', 'Transcript', 'Phonetization', 'Language']
+
+def open_arrow_writer(path:str, output_format:str):
+    # Feather (Arrow IPC) and Parquet files are written a table at a time, like the CSV, and are read back
+    # much faster than a CSV by pandas.read_feather/read_parquet
+    if pa is None:
+        exit(f"ERROR: pyarrow must be installed to write {output_format} files")
+    schema = pa.schema([(column, pa.string()) for column in OUTPUT_COLUMNS])
+    if output_format == 'parquet':
+        return pq.ParquetWriter(path, schema, compression='zstd')
+    return pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression='lz4'))
+
 @click.command()
 @click.argument('input_csv_file', type=click.File('r'))
 @click.argument('output_csv_file', type=click.File('w'))
@@ -20,61 +119,58 @@ def get_lang_code(text:str) -> str:
 @click.option('-t', '--transcript-row', type=click.STRING, default="Transcript", help='The name (in the header) of the row corresponding to the text transcript of the wav file speech content.') # ""
 @click.option('-s','--separator', type=click.STRING, default="\t", help='The separator used in the input csv file.') # "|"
 @click.option('-q', '--quotechar', type=click.STRING, default='|', help='The quotechar used in the input csv file.') # '"'
-def phonetize_sentences(input_csv_file, output_csv_file, lang, basename_row, transcript_row, separator, quotechar):
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(input_csv_file, sep=separator, quotechar=quotechar)
-
-    # Create an empty list to store the matched lines
-    phonetized_lines = []
-
-    # Importing backends for code efficiency
-    backend_en = EspeakBackend('en-us', preserve_punctuation=True)
-    backend_fr = EspeakBackend('fr-fr', preserve_punctuation=True)
-    backend_de = EspeakBackend('de', preserve_punctuation=True)
-    backend_pt = EspeakBackend('pt', preserve_punctuation=True)
-    backend_pl = EspeakBackend('pl', preserve_punctuation=True)
-    backend_nl = EspeakBackend('nl', preserve_punctuation=True)
-    backend_es = EspeakBackend('es', preserve_punctuation=True)
-    backend_it = EspeakBackend('it', preserve_punctuation=True)
-
-    # Match each line of the CSV with the associated line in the WAV list with tqdm progress bar
-    for _, row in tqdm(df.iterrows(), total=len(df)):
-        if lang: 
-            language = lang
-        else:
-            language = get_lang_code(row["Language"])
-        basename = row[basename_row]
-        transcript = row[transcript_row].strip()
-
-        ipa_string = ""
-        if language == "en-us":
-            ipa_string = backend_en.phonemize([transcript])[0]
-        elif language == "fr-fr":
-            ipa_string = backend_fr.phonemize([transcript])[0]
-        elif language == "de":
-            ipa_string = backend_de.phonemize([transcript])[0]
-        elif language == "pt":
-            ipa_string = backend_pt.phonemize([transcript])[0]
-        elif language == "pl":
-            ipa_string = backend_pl.phonemize([transcript])[0]
-        elif language == "nl":
-            ipa_string = backend_nl.phonemize([transcript])[0]
-        elif language == "es":
-            ipa_string = backend_es.phonemize([transcript])[0]
-        elif language == "it":
-            ipa_string = backend_it.phonemize([transcript])[0]
-        else:
-            exit(f"Got an unexpected language code: {language}")
+@click.option('-c', '--chunk-size', type=click.INT, default=1000, help='The number of transcripts given to the phonemizer at once.')
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of processes phonemizing the chunks (defaults to the number of CPUs minus one).')
+@click.option('-r', '--read-size', type=click.INT, default=100_000, help='The number of lines of the input csv file read and written at once.')
+@click.option('-f', '--output-format', type=click.Choice(['csv', 'feather', 'parquet']), default='csv', help='The format of the output file (feather and parquet need pyarrow).')
+@click.option('-e', '--csv-engine', type=click.Choice(['pyarrow', 'c']), default='pyarrow', help='The parser of the input csv file (pyarrow falls back to pandas\' C parser when it is not installed).')
+def phonetize_sentences(input_csv_file, output_csv_file, lang, basename_row, transcript_row, separator, quotechar, chunk_size, jobs, read_size, output_format, csv_engine):
+    jobs = jobs if jobs else max(1, os.cpu_count() - 1)
+    phonemized = {}
+    empty_transcripts = collections.Counter() # Reported once at the end rather than printed for every line
+
+    if output_format == 'csv':
+        # The lines are exported to a new CSV file, with the same format as DataFrame.to_csv
+        writer = csv.writer(output_csv_file, delimiter='\t', quotechar='|', lineterminator='\n')
+        writer.writerow(OUTPUT_COLUMNS)
+    else:
+        # The file is written by pyarrow from its path; output_csv_file itself is never opened
+        arrow_writer = open_arrow_writer(output_csv_file.name, output_format)
+
+    # The CSV file is read, phonemized and written read_size lines at a time, so that the memory used does not
+    # depend on the size of the file. The chunks are phonemized by a pool of jobs processes, which keep their
+    # espeak backends from one block to the next
+    pool = ProcessPoolExecutor(jobs) if jobs > 1 else contextlib.nullcontext()
+    with tqdm(unit=" lines") as progress_bar, pool as executor:
+        columns = [basename_row, transcript_row] if lang else [basename_row, transcript_row, "Language"]
+        for df in iter_csv_blocks(input_csv_file, columns, separator, quotechar, read_size, csv_engine):
+            # Language, basename and transcript of each line of the CSV, read column by column rather than through
+            # df.iterrows(), which builds a Series for every line
+            basenames = df[basename_row].tolist()
+            transcripts = df[transcript_row].str.strip().tolist()
+            if lang:
+                languages = [lang] * len(df)
+            else:
+                # A CSV only holds a few different languages, so each one is resolved once (get_lang_code is cached
+                # across the blocks) and the codes are mapped to the lines
+                lang_codes = {language: get_lang_code(language) for language in pd.unique(df["Language"].to_numpy())}
+                languages = df["Language"].map(lang_codes).tolist()
 
-        if len(ipa_string) <= 0:
-            print(f"That does not seem normal {transcript=} |||||| {ipa_string=}")
+            ipa_strings = phonemize_by_language(transcripts, languages, chunk_size, executor, progress_bar, phonemized)
 
-        phonetized_lines.append([basename, transcript, ipa_string, language])
+            empty_transcripts.update(transcript for transcript, ipa_string in zip(transcripts, ipa_strings) if len(ipa_string) <= 0)
 
-    # Create a DataFrame with the matched lines and export it to a new CSV file
-    phonetized_df = pd.DataFrame(phonetized_lines, columns=['Basename', 'Transcript', 'Phonetization', 'Language'])
-    phonetized_df.to_csv(output_csv_file, sep='\t', quotechar='|', index=False)
+            if output_format == 'csv':
+                writer.writerows(zip(basenames, transcripts, ipa_strings, languages))
+            else:
+                table_columns = [[str(basename) for basename in basenames], transcripts, ipa_strings, languages]
+                arrow_writer.write_table(pa.table(table_columns, names=OUTPUT_COLUMNS))
 
+    if output_format != 'csv':
+        arrow_writer.close()
+    if empty_transcripts:
+        examples = " |||||| ".join(repr(transcript) for transcript, _ in empty_transcripts.most_common(5))
+        print(f"That does not seem normal: {empty_transcripts.total()} lines ({len(empty_transcripts)} different transcripts) got an empty phonetization, e.g. {examples}")
     print("Phonetization completed successfully!")
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import io
+import os
+import csv
+import click
+import itertools
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+# The steps of resample_corpus.py, normalize_corpus.py and trim_silence.py, which are next to this script
+from resample_corpus import load_resampled
+from normalize_corpus import NegativeNumberParamType, normalize_samples
+from trim_silence import trim_loaded_audio
+
+def prefetch_file(file_path:str):
+    # Asks the kernel to start reading the file in the background, so that it is in the page cache by the time
+    # it is decoded (POSIX only, a no-op elsewhere)
+    if file_path is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def to_pcm16(audio:np.ndarray, sr:int) -> np.ndarray:
+    # The int16 samples of the float samples once written to a PCM_16 wav file. The scaling, rounding and clipping
+    # of libsndfile depend on its version, so the conversion is left to libsndfile itself, in memory
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sr, 'PCM_16', format='WAV')
+    buffer.seek(0)
+    return sf.read(buffer, dtype='int16')[0]
+
+def preprocess_file(src_file_path:str, dst_file_path:str, target_sr:int, target_loudness:int, threshold:int, next_src_file_path:str=None):
+    # Resamples, normalizes and trims a file in memory, and writes it once. Gives the same file as
+    # resample_corpus.py, normalize_corpus.py then trim_silence.py, without their intermediate files.
+    # The next file of the same worker is read from the disk in the meantime
+    # A file that fails is reported and left out, the other files are still processed
+    prefetch_file(next_src_file_path)
+    try:
+        audio, sr = load_resampled(src_file_path, target_sr)
+        samples = normalize_samples(to_pcm16(audio, sr), 2 ** 15, target_loudness)
+        lenght, trimmed = trim_loaded_audio((samples.reshape(-1, 1), sr, 2 ** 15, None), threshold)
+        sf.write(dst_file_path, trimmed, sr, 'PCM_16')
+    except Exception as e:
+        return None, None, f"{src_file_path}: {str(e) or type(e).__name__}"
+    return lenght, int(round(1000 * len(trimmed) / sr)), None
+
+def walk_wav_files(src_dir:str):
+    # Lazily yields the wav files below src_dir. os.scandir entries already know whether they are directories,
+    # so nothing is stat'ed again as os.walk does
+    pending_dirs = [src_dir]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.name.endswith(".wav"):
+                    yield entry.path
+
+def preprocess_audio(src_dir:str, dst_dir:str, target_sr:int, target_loudness:int, threshold:int, jobs:int=None):
+    try:
+        # Recursively create the same directory structure in the target directory
+        src_file_paths, dst_file_paths, created_dirs = [], [], set()
+        prefix_length = len(os.path.join(src_dir, "")) # Relative paths are sliced out rather than computed by os.path.relpath
+        for src_file_path in walk_wav_files(src_dir):
+            dst_file_path = os.path.join(dst_dir, src_file_path[prefix_length:])
+
+            # Create the target directory if it doesn't exist, once per directory and here rather than in the workers,
+            # which would race
+            dst_file_dir = os.path.dirname(dst_file_path)
+            if dst_file_dir not in created_dirs:
+                os.makedirs(dst_file_dir, exist_ok=True)
+                created_dirs.add(dst_file_dir)
+            src_file_paths.append(src_file_path)
+            dst_file_paths.append(dst_file_path)
+
+        # The files are independent, so they are processed by a pool of processes
+        with ProcessPoolExecutor(jobs) as executor:
+            results = executor.map(preprocess_file, src_file_paths, dst_file_paths, itertools.repeat(target_sr), itertools.repeat(target_loudness), itertools.repeat(threshold), src_file_paths[1:] + [None], chunksize=8)
+            results = list(tqdm(results, total=len(src_file_paths), desc="Preprocessing audio files"))
+        errors = [error for _, _, error in results if error]
+        for error in errors:
+            print(f"Error: {error}")
+
+        # Same columns as the report of trim_silence.py, but for the trim parameters (always the defaults here)
+        os.makedirs(dst_dir, exist_ok=True)
+        report_path = os.path.join(dst_dir, "silence_report.csv")
+        dst_prefix_length = len(os.path.join(dst_dir, ""))
+        with open(report_path, 'w', newline='') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["path", "original_ms", "trimmed_ms", "removed_ms"])
+            writer.writerows((dst_file_path[dst_prefix_length:], lenght, length_trimmed, lenght - length_trimmed)
+                             for dst_file_path, (lenght, length_trimmed, error) in zip(dst_file_paths, results) if not error)
+
+        print(f"Directory structure replicated and audio files resampled, normalized and trimmed from '{src_dir}' to '{dst_dir}'. {len(results) - len(errors)} wav files have been preprocessed, {len(errors)} failed. See '{report_path}' for the trimmed durations.")
+        print("WARNING ! Although the directory structure was copied, ONLY THE WAV FILES were copied.")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+
+@click.command()
+@click.argument('src_directory', type=click.Path(exists=True))
+@click.argument('dst_directory', type=click.Path())
+@click.option('--rate', type=click.INT, default=22050, help='The desired sampling rate.')
+@click.option('--db', type=NegativeNumberParamType(), default=-23, help='The desired loudness in dB LUFS (Loudness Units Full Scale).')
+@click.option('--silence-db', type=NegativeNumberParamType(), default=-40, help='The desired loudness threshold in dB LUFS (Loudness Units Full Scale) to identify silent areas.')
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of processes preprocessing the files (defaults to the number of CPUs).')
+def preprocess_and_replicate(src_directory, dst_directory, rate, db, silence_db, jobs):
+    preprocess_audio(src_directory, dst_directory, rate, db, silence_db, jobs)
+
+if __name__ == '__main__':
+    preprocess_and_replicate()
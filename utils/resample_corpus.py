@@ -1,24 +1,93 @@
 import os
+import shutil
+import itertools
 import click
 import librosa
+import soxr
+import numpy as np
 import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
 
-def resample_audio(src_dir:str, dst_dir:str, target_sr:int):
+def prefetch_file(file_path:str):
+    # Asks the kernel to start reading the file in the background, so that it is in the page cache by the time
+    # it is decoded (POSIX only, a no-op elsewhere)
+    if file_path is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def load_resampled(file_path:str, target_sr:int):
+    # Gives the same samples as librosa.load(file_path, sr=target_sr) (mono, float32, soxr_hq resampling fixed to
+    # the same length), reading the file with soundfile and resampling it with soxr directly, without librosa's
+    # generic loading and resampling layers. The files soundfile can't read are left to librosa
+    try:
+        audio, sr = sf.read(file_path, dtype='float32')
+    except RuntimeError:
+        return librosa.load(file_path, sr=target_sr)
+    if audio.ndim > 1:
+        audio = np.mean(audio, axis=1)
+    if sr != target_sr:
+        n_samples = int(np.ceil(len(audio) * float(target_sr) / sr))
+        audio = soxr.resample(audio, sr, target_sr, quality='soxr_hq')[:n_samples]
+        audio = np.pad(audio, (0, n_samples - len(audio)))
+    return audio, target_sr
+
+def resample_file(src_file_path:str, dst_file_path:str, target_sr:int, next_src_file_path:str=None):
+    prefetch_file(next_src_file_path) # The next file of the same worker is read from the disk while this one is resampled
+    try:
+        info = sf.info(src_file_path)
+    except RuntimeError:
+        info = None # Not readable by soundfile, left to librosa
+    if info is not None and info.format == 'WAV' and info.subtype == 'PCM_16' and info.channels == 1 and info.samplerate == target_sr:
+        # Already a mono 16 bit file at the target rate: the file is copied rather than decoded and encoded again
+        shutil.copyfile(src_file_path, dst_file_path)
+        return
+    audio, sr = load_resampled(src_file_path, target_sr)
+    sf.write(dst_file_path, audio, sr, 'PCM_16')
+
+def walk_wav_files(src_dir:str):
+    # Lazily yields the wav files below src_dir. os.scandir entries already know whether they are directories,
+    # so nothing is stat'ed again as os.walk does
+    pending_dirs = [src_dir]
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.name.endswith(".wav"):
+                    yield entry.path
+
+def resample_audio(src_dir:str, dst_dir:str, target_sr:int, jobs:int=None):
     try:
         # Recursively create the same directory structure in the target directory
-        for root, _, files in os.walk(src_dir):
-            for file in files:
-                if not file.endswith(".wav"):
-                    continue
-                src_file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(src_file_path, src_dir)
-                dst_file_path = os.path.join(dst_dir, relative_path)
+        src_file_paths, dst_file_paths, created_dirs = [], [], set()
+        prefix_length = len(os.path.join(src_dir, "")) # Relative paths are sliced out rather than computed by os.path.relpath
+        for src_file_path in walk_wav_files(src_dir):
+            dst_file_path = os.path.join(dst_dir, src_file_path[prefix_length:])
 
-                # Create the target directory if it doesn't exist
-                os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
+            # Create the target directory if it doesn't exist, once per directory and here rather than in the workers,
+            # which would race
+            dst_file_dir = os.path.dirname(dst_file_path)
+            if dst_file_dir not in created_dirs:
+                os.makedirs(dst_file_dir, exist_ok=True)
+                created_dirs.add(dst_file_dir)
+            src_file_paths.append(src_file_path)
+            dst_file_paths.append(dst_file_path)
 
-                audio, sr = librosa.load(src_file_path, sr=target_sr)
-                sf.write(dst_file_path, audio, sr, 'PCM_16')
+        # The files are independent, so they are resampled by a pool of processes. Their number is capped by default,
+        # as librosa may start a decoder process for each file
+        jobs = jobs if jobs else min(os.cpu_count(), 8)
+        with ProcessPoolExecutor(jobs) as executor:
+            results = executor.map(resample_file, src_file_paths, dst_file_paths, itertools.repeat(target_sr), src_file_paths[1:] + [None], chunksize=8)
+            for _ in tqdm(results, total=len(src_file_paths), desc="Resampling audio files"):
+                pass
 
         print(f"Directory structure replicated and audio files normalized from '{src_dir}' to '{dst_dir}'.")
         print("WARNING ! Although the directory structure was copied, ONLY THE WAV FILES were copied.")
@@ -29,8 +98,9 @@ def resample_audio(src_dir:str, dst_dir:str, target_sr:int):
 @click.argument('src_directory', type=click.Path(exists=True))
 @click.argument('dst_directory', type=click.Path())
 @click.option('--rate', type=click.INT, default=22050, help='The desired sampling rate.')
-def resample_and_replicate(src_directory, dst_directory, rate):
-    resample_audio(src_directory, dst_directory, rate)
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of processes resampling the files (defaults to the number of CPUs, at most 8).')
+def resample_and_replicate(src_directory, dst_directory, rate, jobs):
+    resample_audio(src_directory, dst_directory, rate, jobs)
 
 if __name__ == '__main__':
     resample_and_replicate()
@@ -1,32 +1,57 @@
 import os
-import glob
-import librosa
+import itertools
 import click
 import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from resample_corpus import load_resampled # resample_corpus.py is next to this script
 
-def resample_audio_files(directory, target_sr):
+def resample_file(audio_file:str, target_sr:int):
+    try:
+        info = sf.info(audio_file)
+    except RuntimeError:
+        info = None # Not readable by soundfile, left to librosa
+    if info is not None and info.format == 'WAV' and info.subtype == 'PCM_16' and info.channels == 1 and info.samplerate == target_sr:
+        return # Already a mono 16 bit file at the target rate: it would be written back unchanged
+    y, sr = load_resampled(audio_file, target_sr) # Same samples as librosa.load(audio_file, sr=target_sr)
+    sf.write(audio_file, y, sr, 'PCM_16') # PCM_24
+
+def iter_wav_files(directory:str):
+    # Same files as glob's '**/*.wav' pattern (hidden files and directories are skipped), yielded as the
+    # directories are read, with a single os.scandir per directory and a suffix check instead of fnmatch
+    directories = [directory]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.name.endswith('.wav'):
+                    yield entry.path
+
+def resample_audio_files(directory, target_sr, jobs=None):
     # Check if the provided path is a directory
     if not os.path.isdir(directory):
         click.echo('Error: The provided path is not a directory.')
         return
 
     # Find all audio files in the directory
-    audio_files = glob.glob(os.path.join(directory, '**/*.wav'), recursive=True)
+    audio_files = list(iter_wav_files(directory))
 
-    # Resample and save each audio file
-    with tqdm(total=len(audio_files), desc="Resampling audio files") as pbar:
-        for audio_file in audio_files:
-            y, sr = librosa.load(audio_file, sr=target_sr)
-            sf.write(audio_file, y, sr, 'PCM_16') # PCM_24
-            pbar.update(1)
+    # Resample and save each audio file. The files are independent, so they are resampled by a pool of processes
+    jobs = jobs if jobs else min(os.cpu_count(), 8)
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(resample_file, audio_files, itertools.repeat(target_sr), chunksize=8)
+        for _ in tqdm(results, total=len(audio_files), desc="Resampling audio files"):
+            pass
 
 @click.command()
 @click.argument('directory', type=click.Path(exists=True, file_okay=False, resolve_path=True))
 @click.option('--target-sr', default=22050, help='Target sampling rate')
-def main(directory, target_sr):
-    resample_audio_files(directory, target_sr)
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of processes resampling the files (defaults to the number of CPUs, at most 8).')
+def main(directory, target_sr, jobs):
+    resample_audio_files(directory, target_sr, jobs)
 
 if __name__ == '__main__':
     main()
-
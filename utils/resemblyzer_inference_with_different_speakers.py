@@ -1,25 +1,71 @@
 import os
+import functools
 from resemblyzer import VoiceEncoder, preprocess_wav
-from scipy.spatial.distance import cosine, euclidean
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import argparse
 import numpy as np
+import torch
 import csv
-from scipy.stats import bootstrap
+from tqdm import tqdm
+# The embedding, caching and scoring functions are shared with compute_cos_sim.py, next to this script
+from compute_cos_sim import cached_preprocess_wav, embed_wavs, load_embedding_cache, save_embedding_cache, quantize_embeddings, batch_scores
 
 # This script computes Cosinus Similarity for a given set of audio files
 
 # Example of use: 
 # python resemblyzer_inference_with_different_speakers.py --data_dir /vrac/dguennec/dev/espnet/egs/ssw12/tts1/synthesis/ --ref_dir /vrac/dguennec/dev/espnet/egs/ssw12/tts1/downloads/test_natural_set/test_natural/ --output_csv_file resemblyzer_foobar.csv --output_log_file resemblyzer_log.log --output_model_stats resemblyzer_models.csv --output_speaker_stats resemblyzer_speaker.csv
 
-def get_embedding(filepath, model):
-    ref_wav = preprocess_wav(filepath)
-    ref_embed = model.embed_utterance(ref_wav)
-    
-    return ref_embed
-
-
-def compute_cosine_similarity(x, y):
-    return 1 - cosine(x, y)
+def preprocess_wav_or_none(filepath, cache=False):
+    try:
+        return cached_preprocess_wav(filepath) if cache else preprocess_wav(filepath)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def embed_files(filepaths, model, batch_size=32, executor=None, cache=False):
+    # Same embeddings as compute_cos_sim.get_embedding, but the partial utterances of all the files go through the model
+    # together, batch_size at a time. Files that cannot be read get None instead of an embedding.
+    # The files are preprocessed by executor (a thread pool by default) while the model stays in this process,
+    # and with cache, the preprocessed wavs are kept on disk for the next runs
+    preprocess = functools.partial(preprocess_wav_or_none, cache=cache)
+    if executor is None:
+        with ThreadPoolExecutor() as executor:
+            wavs = list(executor.map(preprocess, filepaths))
+    else:
+        wavs = list(executor.map(preprocess, filepaths, chunksize=4))
+
+    readable = [i for i, wav in enumerate(wavs) if wav is not None]
+    embeds = [None] * len(filepaths)
+    for i, embed in zip(readable, embed_wavs([wavs[i] for i in readable], model, batch_size)):
+        embeds[i] = embed
+    return embeds
+
+
+def grouped_bootstrap_mean_ci(groups, n_resamples=9999, ci=0.95, rng=None, max_draws=1 << 23):
+    # Means and percentile bootstrap confidence intervals of the means of several groups of scores, all computed
+    # together: each resample is one ragged row with the draws of every group, and the groups are averaged by
+    # np.add.reduceat. The chunks of resamples bound the memory used by the index matrix. Empty groups get nan
+    rng = rng if rng is not None else np.random.default_rng()
+    lens = np.array([len(group) for group in groups], dtype=np.int64)
+    means, lows, highs = np.full(len(groups), np.nan), np.full(len(groups), np.nan), np.full(len(groups), np.nan)
+    nonempty = np.flatnonzero(lens)
+    if len(nonempty) == 0:
+        return means, lows, highs
+    scores = np.concatenate([np.asarray(groups[i], dtype=np.float32) for i in nonempty])
+    lens = lens[nonempty]
+    starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    means[nonempty] = np.add.reduceat(scores, starts, dtype=np.float64) / lens
+
+    # Each draw picks a score in its own group, between the start of the group and the start of the next one
+    draw_low = np.repeat(starts, lens)
+    draw_high = draw_low + np.repeat(lens, lens)
+    chunk = max(1, max_draws // len(scores))
+    resampled_means = np.concatenate([np.add.reduceat(scores[rng.integers(draw_low, draw_high, size=(min(chunk, n_resamples - start), len(scores)))],
+                                                      starts, axis=1, dtype=np.float64) / lens
+                                      for start in range(0, n_resamples, chunk)])
+    lows[nonempty], highs[nonempty] = np.quantile(resampled_means, [(1 - ci) / 2, 1 - (1 - ci) / 2], axis=0)
+    return means, lows, highs
 
 
 if __name__ == "__main__":
@@ -30,6 +76,12 @@ if __name__ == "__main__":
     parser.add_argument('--output_log_file', help='Where to save the means/std of the objective evaluation')
     parser.add_argument('--output_model_stats', help='Where to save the means/std of the objective evaluation')
     parser.add_argument('--output_speaker_stats', help='Where to save the means/std of the objective evaluation')
+    parser.add_argument('--embedding_cache_file', '--ref_cache_file', default=None, help='Where to keep the embeddings of the wav files between runs (.npz, optional)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the bootstrap resampling, so that the confidence intervals can be reproduced')
+    parser.add_argument('--n_resamples', type=int, default=9999, help='Number of bootstrap resamples for the confidence intervals')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of files preprocessed in parallel (defaults to the number of CPUs)')
+    parser.add_argument('--preprocess_cache', action='store_true', help='Keep the preprocessed wavs next to the wav files (.pp<version>.npy) and reuse them in the next runs')
+    parser.add_argument('--int8', action='store_true', help='Compare the embeddings quantized to int8 (faster with SimSIMD, the similarities differ by up to about 3e-3)')
 
     args = parser.parse_args()
     data_dir = args.data_dir
@@ -39,99 +91,124 @@ if __name__ == "__main__":
     output_speaker_stats = args.output_speaker_stats
     output_model_stats = args.output_model_stats
 
-    speaker_encoder = VoiceEncoder()
+    speaker_encoder = VoiceEncoder(device='cuda' if torch.cuda.is_available() else 'cpu')
+    speaker_encoder.eval() # Set once, the model is only used for inference
+    rng = np.random.default_rng(args.seed) # A single generator for all the bootstrap resamplings
+    # The reference files are shared by all the models, so each one is embedded only once. With a cache file, the
+    # embeddings of all the files are also kept for the next runs, which only embed the new or modified files
+    embeds = load_embedding_cache(args.embedding_cache_file, speaker_encoder)
+
+    # Index of the reference files by speaker and file name, instead of checking the existence of every reference
+    # path built from a wav file name. Each speaker directory is scanned once, the first time one of its files is needed
+    ref_index = {}
     
-    with open(output_csv_file, 'w') as outfi, open(output_log_file, 'w') as log_outfi, open(output_speaker_stats, 'w') as stats_speaker_outfi, open(output_model_stats, 'w') as stats_model_outfi:
+    # The outputs are written through 1 MiB buffers, to make fewer (possibly networked) writes on large evaluations
+    # preprocess_wav (resampling and voice activity detection) is CPU bound, so it runs in worker processes, unless
+    # the model is on a GPU (CUDA cannot be used in forked processes), in which case it runs in threads.
+    # The encoder is only used by this process, under a single inference_mode
+    executor_class = ProcessPoolExecutor if speaker_encoder.device.type == 'cpu' else ThreadPoolExecutor
+    with torch.inference_mode(), executor_class(max_workers=args.jobs) as preprocess_executor, open(output_csv_file, 'w', newline='', buffering=1<<20) as outfi, open(output_log_file, 'w', buffering=1<<20) as log_outfi, open(output_speaker_stats, 'w', newline='', buffering=1<<20) as stats_speaker_outfi, open(output_model_stats, 'w', newline='', buffering=1<<20) as stats_model_outfi:
         fieldnames = ['model', 'speaker', 'cloned_wav','ref', 'cosine_similarity', 'euclidean_similarity']
-        writer = csv.DictWriter(outfi, fieldnames=fieldnames)
-        writer.writeheader()
+        writer = csv.writer(outfi)
+        writer.writerow(fieldnames)
 
-        # Prepare stats
-        dict_stats_speaker = {}
-        dict_stats_model = {}
-        for model_name in os.listdir(data_dir):
-            dict_stats_speaker[model_name] = {}
+        # The raw scores of every speaker of every model, the stats are computed from them once all the files are scored
+        scores_for_stats = {}
+        # os.scandir entries know whether they are directories, without an extra stat() per entry
+        model_entries = [entry for entry in os.scandir(data_dir) if entry.is_dir()]
 
         # Compute speaker similarity
-        for model_name in os.listdir(data_dir):
-            path_model_name = os.path.join(data_dir, model_name)
-            log_outfi.write("Model : " + str(model_name) + "\n")
-            mod_cosine_similarity_list, mod_euclidean_distance_list = [], []
-            
-            for speaker in os.listdir(path_model_name):
-                log_outfi.write("Speaker : " + str(speaker) + "\n")
-                path_model_speaker = os.path.join(path_model_name, speaker)
-                sp_cosine_similarity_list, sp_euclidean_distance_list = [], []
-
-                for cloned_wav in os.listdir(path_model_speaker):
-                    if os.path.splitext(cloned_wav)[1]=='.wav':
-                        cloned_wav_path = os.path.join(path_model_speaker, cloned_wav)
-
+        for model_entry in tqdm(model_entries, desc="Models", mininterval=1.0):
+            model_name, path_model_name = model_entry.name, model_entry.path
+            scores_for_stats[model_name] = {}
+
+            for speaker_entry in os.scandir(path_model_name):
+                if not speaker_entry.is_dir():
+                    continue
+                speaker = speaker_entry.name
+                path_model_speaker = speaker_entry.path
+
+                cloned_wav_paths, ref_paths = [], []
+                if speaker not in ref_index:
+                    ref_speaker_dir = os.path.join(ref_dir, speaker)
+                    ref_index[speaker] = {entry.name: entry.path for entry in os.scandir(ref_speaker_dir) if entry.is_file()} if os.path.isdir(ref_speaker_dir) else {}
+                speaker_refs = ref_index[speaker]
+                speaker_underscore = speaker + "_"
+                for cloned_wav_entry in os.scandir(path_model_speaker):
+                    cloned_wav = cloned_wav_entry.name
+                    if os.path.splitext(cloned_wav)[1]=='.wav' and cloned_wav_entry.is_file():
                         # Parse to find corresponding ref_file
-                        speaker_underscore = speaker + "_"
-                        sample_raw_name = cloned_wav.split(speaker_underscore)[-1]
-                        sample_raw_name = sample_raw_name.split("_synthesis")[0] + ".wav"
-                        ref_path = os.path.join(ref_dir, speaker)
-                        ref_path = os.path.join(ref_path, sample_raw_name)
-
-                        try:
-                            # Compute speaker similarity
-                            ref_embed = get_embedding(ref_path, speaker_encoder)
-                            cloned_embed = get_embedding(cloned_wav_path, speaker_encoder)
-                            cosine_similarity = compute_cosine_similarity(ref_embed, cloned_embed)
-                            euclidean_distance = euclidean(ref_embed, cloned_embed)
-                        except Exception as e:
-                            print(e)
-                        
-                        # Write results in outfi
-                        writer.writerow({'model': str(model_name), 'speaker': str(speaker), 'cloned_wav': str(cloned_wav_path), 'ref': str(ref_path), 'cosine_similarity': str(cosine_similarity), 'euclidean_similarity': str(euclidean_distance)})
-
-                        # Store for mean/std computation
-                        sp_cosine_similarity_list.append(cosine_similarity)
-                        # sp_euclidean_distance_list.append(euclidean_distance)
-                        mod_cosine_similarity_list.append(cosine_similarity)
-                        # mod_euclidean_distance_list.append(euclidean_distance)
-                
-                # Compute the mean and standard deviation or accuracy
-                cosine_similarity_mean, cosine_similarity_std = np.mean(sp_cosine_similarity_list), np.std(sp_cosine_similarity_list)
-                # euclidean_distance_mean, euclidean_distance_std = np.mean(sp_euclidean_distance_list), np.std(sp_euclidean_distance_list)
-                log_outfi.write("Speaker mean cosine similarity = " + str(cosine_similarity_mean) + "\n")
-                # log_outfi.write("Speaker std cosine similarity = " + str(cosine_similarity_std))
-                # log_outfi.write("Speaker mean euclidean distance = " + str(cosine_similarity_mean))
-                # log_outfi.write("Speaker std euclidean distance = " + str(cosine_similarity_std))
-                confidence_interval = bootstrap((sp_cosine_similarity_list,), np.mean, confidence_level=0.95,random_state=np.random.default_rng())
-                log_outfi.write("Lower confidence interval = " + str(confidence_interval.confidence_interval.low) + "\n")
-                log_outfi.write("Higher confidence interval = " + str(confidence_interval.confidence_interval.high) + "\n")
-                log_outfi.write("Confidence +- = " + str((confidence_interval.confidence_interval.high - confidence_interval.confidence_interval.low)/2) + "\n")
-                result_for_stats = str(cosine_similarity_mean) + " +/- " + str((confidence_interval.confidence_interval.high - confidence_interval.confidence_interval.low)/2)
-                dict_stats_speaker[model_name][speaker] = result_for_stats
-            
-            # Compute the mean and standard deviation or accuracy
-            cosine_similarity_mean, cosine_similarity_std = np.mean(mod_cosine_similarity_list), np.std(mod_cosine_similarity_list)
-            # euclidean_distance_mean, euclidean_distance_std = np.mean(mod_euclidean_distance_list), np.std(mod_euclidean_distance_list)
-            log_outfi.write("Model mean cosine similarity = " + str(cosine_similarity_mean) + "\n")
-            # log_outfi.write("Model std cosine similarity = " + str(cosine_similarity_std))
-            # log_outfi.write("Model mean euclidean distance = " + str(cosine_similarity_mean))
-            # log_outfi.write("Model std euclidean distance = " + str(cosine_similarity_std))
-            confidence_interval = bootstrap((mod_cosine_similarity_list,), np.mean, confidence_level=0.95,random_state=np.random.default_rng())
-            log_outfi.write("Lower confidence interval = " + str(confidence_interval.confidence_interval.low) + "\n")
-            log_outfi.write("Higher confidence interval = " + str(confidence_interval.confidence_interval.high) + "\n")
-            log_outfi.write("Confidence +- = " + str((confidence_interval.confidence_interval.high - confidence_interval.confidence_interval.low)/2) + "\n")
-            result_for_stats = str(cosine_similarity_mean) + " +/- " + str((confidence_interval.confidence_interval.high - confidence_interval.confidence_interval.low)/2)
-            dict_stats_model[model_name] = result_for_stats
-        
-        fieldnames_speaker = ['Model', 'Speaker', 'Mean Cosine Similarity']
-        writer_stats_speaker = csv.DictWriter(stats_speaker_outfi, fieldnames=fieldnames_speaker)
-        writer_stats_speaker.writeheader()
-        for model_name in dict_stats_speaker.keys():
-            for speaker in dict_stats_speaker[model_name].keys():
-                writer_stats_speaker.writerow({'Model': str(model_name), 'Speaker': str(speaker), 'Mean Cosine Similarity': dict_stats_speaker[model_name][speaker]})
-
-        fieldnames_model = ['Model', 'Mean Cosine Similarity']
-        writer_stats_model = csv.DictWriter(stats_model_outfi, fieldnames=fieldnames_model)
-        writer_stats_model.writeheader()
-        for model_name in dict_stats_model.keys():
-            writer_stats_model.writerow({'Model': str(model_name), 'Mean Cosine Similarity': dict_stats_model[model_name]})
-
-
+                        # (the partitions make no intermediate list, and rpartition keeps the name whole if there is no speaker_underscore)
+                        sample_raw_name = cloned_wav.rpartition(speaker_underscore)[2].partition("_synthesis")[0] + ".wav"
+                        ref_path = speaker_refs.get(sample_raw_name)
+                        if ref_path is None:
+                            print(f"No reference file {sample_raw_name} for {cloned_wav_entry.path}")
+                            continue
+                        cloned_wav_paths.append(cloned_wav_entry.path)
+                        ref_paths.append(ref_path)
+
+                # All the files of the speaker are embedded together, and only the ones not seen yet
+                if args.embedding_cache_file is not None:
+                    new_paths = sorted((set(ref_paths) | set(cloned_wav_paths)) - embeds.keys())
+                    embeds.update(zip(new_paths, embed_files(new_paths, speaker_encoder, executor=preprocess_executor, cache=args.preprocess_cache)))
+                    cloned_embeds = [embeds[cloned_wav_path] for cloned_wav_path in cloned_wav_paths]
+                else:
+                    new_ref_paths = sorted(set(ref_paths) - embeds.keys())
+                    embeds.update(zip(new_ref_paths, embed_files(new_ref_paths, speaker_encoder, executor=preprocess_executor, cache=args.preprocess_cache)))
+                    cloned_embeds = embed_files(cloned_wav_paths, speaker_encoder, executor=preprocess_executor, cache=args.preprocess_cache)
+
+                # Compute speaker similarity, for all the files of the speaker at once
+                pairs = [(cloned_wav_path, ref_path, cloned_embed) for cloned_wav_path, ref_path, cloned_embed in zip(cloned_wav_paths, ref_paths, cloned_embeds)
+                         if cloned_embed is not None and embeds[ref_path] is not None]
+                cosine_similarities, euclidean_distances = [], []
+                if pairs:
+                    ref_embeds = np.stack([embeds[ref_path] for _, ref_path, _ in pairs])
+                    cloned_embeds = np.stack([cloned_embed for _, _, cloned_embed in pairs])
+                    if args.int8:
+                        # Only the compared copies are quantized, the cached embeddings stay float16
+                        ref_embeds, cloned_embeds = quantize_embeddings(ref_embeds), quantize_embeddings(cloned_embeds)
+                    cosine_similarities, euclidean_distances = batch_scores(ref_embeds, cloned_embeds)
+
+                # Write results in outfi, all the rows of the speaker at once and without building a dict per row
+                writer.writerows((model_name, speaker, cloned_wav_path, ref_path, cosine_similarity, euclidean_distance)
+                                 for (cloned_wav_path, ref_path, _), cosine_similarity, euclidean_distance in zip(pairs, cosine_similarities, euclidean_distances))
+
+                # Store for mean/std computation
+                scores_for_stats[model_name][speaker] = np.asarray(cosine_similarities, dtype=np.float32)
+
+        # Compute the mean and confidence interval of every speaker and of every model in a single pass
+        groups = [(model_name, speaker) for model_name, speakers in scores_for_stats.items() for speaker in speakers]
+        groups += [(model_name, None) for model_name in scores_for_stats]
+        cosine_similarity_means, confidence_lows, confidence_highs = grouped_bootstrap_mean_ci(
+            [scores_for_stats[model_name][speaker] if speaker is not None else np.concatenate([np.empty(0, dtype=np.float32), *scores_for_stats[model_name].values()])
+             for model_name, speaker in groups], n_resamples=args.n_resamples, ci=0.95, rng=rng)
+        stats = {group: (cosine_similarity_mean, confidence_low, confidence_high, (confidence_high - confidence_low)/2)
+                 for group, cosine_similarity_mean, confidence_low, confidence_high in zip(groups, cosine_similarity_means, confidence_lows, confidence_highs)}
+
+        def log_stats(level, cosine_similarity_mean, confidence_low, confidence_high, confidence):
+            return (level + " mean cosine similarity = " + str(cosine_similarity_mean) + "\n"
+                    + "Lower confidence interval = " + str(confidence_low) + "\n"
+                    + "Higher confidence interval = " + str(confidence_high) + "\n"
+                    + "Confidence +- = " + str(confidence) + "\n")
+
+        # The messages of a model are joined and written at once, instead of one small write per line
+        for model_name, speakers in scores_for_stats.items():
+            log_messages = ["Model : " + str(model_name) + "\n"]
+            for speaker in speakers:
+                log_messages.append("Speaker : " + str(speaker) + "\n")
+                log_messages.append(log_stats("Speaker", *stats[model_name, speaker]))
+            log_messages.append(log_stats("Model", *stats[model_name, None]))
+            log_outfi.write("".join(log_messages))
+
+        writer_stats_speaker = csv.writer(stats_speaker_outfi)
+        writer_stats_speaker.writerow(['Model', 'Speaker', 'Mean Cosine Similarity'])
+        writer_stats_speaker.writerows((model_name, speaker, str(stats[model_name, speaker][0]) + " +/- " + str(stats[model_name, speaker][3]))
+                                       for model_name, speakers in scores_for_stats.items() for speaker in speakers)
+
+        writer_stats_model = csv.writer(stats_model_outfi)
+        writer_stats_model.writerow(['Model', 'Mean Cosine Similarity'])
+        writer_stats_model.writerows((model_name, str(stats[model_name, None][0]) + " +/- " + str(stats[model_name, None][3]))
+                                     for model_name in scores_for_stats)
+
+    save_embedding_cache(args.embedding_cache_file, embeds, speaker_encoder)
     print("My job here is done.")
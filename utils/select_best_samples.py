@@ -1,28 +1,48 @@
-import csv
 import click
+import numpy as np
 
 def filter_and_save_csv(input_csv, output_csv, size_threshold=600000):
-    # Initialize lists to store rows that meet the size threshold
-    selected_rows = []
-    total_size = 0
-
-    with open(input_csv, 'r') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter="\t", quotechar='|')
-        fieldnames = reader.fieldnames
-
-        # Sort rows by score in descending order
-        sorted_rows = sorted(reader, key=lambda row: float(row['MOS']), reverse=True)
-
-        for row in sorted_rows:
-            # Check if adding the row would exceed the size threshold
-            if total_size + float(row['Duration']) <= size_threshold:
-                selected_rows.append(row)
-                total_size += float(row['Duration'])
-
-    with open(output_csv, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter="\t", quotechar='|')
-        writer.writeheader()
-        writer.writerows(selected_rows)
+    # Only the MOS and Duration columns are needed: rows are kept as raw lines and written back
+    # untouched instead of being decoded into dicts of strings and re-encoded by a DictWriter
+    with open(input_csv, 'rb') as csvfile:
+        header = csvfile.readline()
+        lines = [line for line in csvfile.readlines() if line.strip()]
+
+    fieldnames = [field.strip(b'|') for field in header.rstrip(b'\r\n').split(b'\t')]
+    score_idx, duration_idx = fieldnames.index(b'MOS'), fieldnames.index(b'Duration')
+
+    scores, durations = [], []
+    for line in lines:
+        parts = line.split(b'\t')
+        scores.append(float(parts[score_idx].strip(b'|')))
+        durations.append(float(parts[duration_idx].strip(b'|')))
+
+    # Sort rows by score in descending order
+    sorted_idx = sorted(range(len(lines)), key=scores.__getitem__, reverse=True)
+
+    # The rows are all kept up to the first one that would exceed the size threshold, as found by a cumulative sum
+    # (np.cumsum adds them in order, so the totals are the same as the loop's)
+    sorted_durations = np.array(durations, dtype=np.float64)[sorted_idx]
+    totals = np.cumsum(sorted_durations)
+    exceeded = ~(totals <= size_threshold) # A NaN duration counts as exceeding the threshold, as in the loop
+    n_kept = int(np.argmax(exceeded)) if exceeded.any() else len(sorted_idx)
+    selected_idx = sorted_idx[:n_kept]
+    total_size = float(totals[n_kept - 1]) if n_kept else 0
+
+    # Shorter rows may still fit after it. The loop stops as soon as even the shortest of the remaining rows would exceed it
+    shortest_remaining = np.minimum.accumulate(sorted_durations[::-1])[::-1]
+    for k in range(n_kept, len(sorted_idx)):
+        if shortest_remaining[k] >= 0 and total_size + shortest_remaining[k] > size_threshold:
+            break
+        # Check if adding the row would exceed the size threshold
+        if total_size + sorted_durations[k] <= size_threshold:
+            selected_idx.append(sorted_idx[k])
+            total_size += sorted_durations[k]
+
+    with open(output_csv, 'wb') as csvfile:
+        csvfile.write(header)
+        for i in selected_idx:
+            csvfile.write(lines[i] if lines[i].endswith(b'\n') else lines[i] + b'\n')
 
 @click.command()
 @click.argument('input_csv', type=click.Path(exists=True))
@@ -1,7 +1,21 @@
 import os
+import re
+import csv
 import click
+import queue
+import threading
+import subprocess
+import numpy as np
+import soundfile as sf
+from itertools import islice
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
+from concurrent.futures import ThreadPoolExecutor
+from tqdm.contrib.concurrent import process_map
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 class NegativeNumberParamType(click.ParamType):
     name = 'negative_numbers_only'
@@ -9,56 +23,485 @@ class NegativeNumberParamType(click.ParamType):
     def convert(self, value, param, ctx):
         try:
             number = float(value)
-            if number < 0:
-                return number
-            else:
-                self.fail(f'{value} is not a negative number. Values passed in dB LUFS cannot be positive.', param, ctx)
         except ValueError:
             self.fail(f'{value} is not a valid number. Values passed in dB LUFS should be, well... numerical values.', param, ctx)
+        if number >= 0:
+            self.fail(f'{value} is not a negative number. Values passed in dB LUFS cannot be positive.', param, ctx)
+        return number
+
+def _silent_ranges_loop(starts, is_silent, seek_step, min_silence_len):
+    # Single pass over the windows: a new silent range begins whenever two silent windows neither follow each other nor overlap
+    ranges = np.empty((starts.size, 2), dtype=np.int64)
+    n_ranges = 0
+    prev_start = -1
+    for i in range(starts.size):
+        if not is_silent[i]:
+            continue
+        start = starts[i]
+        if prev_start < 0:
+            ranges[0, 0] = start
+        elif start - prev_start != seek_step and start - prev_start > min_silence_len:
+            ranges[n_ranges, 1] = prev_start + min_silence_len
+            n_ranges += 1
+            ranges[n_ranges, 0] = start
+        prev_start = start
+    if prev_start < 0:
+        return ranges[:0]
+    ranges[n_ranges, 1] = prev_start + min_silence_len
+    return ranges[:n_ranges + 1]
+
+def _silent_ranges_numpy(starts, is_silent, seek_step, min_silence_len):
+    # Same ranges as _silent_ranges_loop, found with whole array operations when numba is not installed
+    silence_starts = starts[is_silent]
+    if silence_starts.size == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    gaps = np.diff(silence_starts)
+    breaks = np.flatnonzero((gaps != seek_step) & (gaps > min_silence_len))
+    range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+    range_ends = silence_starts[np.concatenate((breaks, [silence_starts.size - 1]))] + min_silence_len
+    return np.stack((range_starts, range_ends), axis=1)
+
+# numba is optional: it compiles the loop above, which avoids the temporary arrays of the NumPy version
+_silent_ranges = njit(cache=True)(_silent_ranges_loop) if njit else _silent_ranges_numpy
+
+_scratch = threading.local()
+
+def _scratch_buffer(name:str, size:int, dtype) -> np.ndarray:
+    # The buffers of the detection are kept from one file to the next (one set per thread) and only
+    # reallocated when a longer file comes, instead of allocating several arrays of the file's size for every file
+    buffer = getattr(_scratch, name, None)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = np.empty(size, dtype=dtype)
+        setattr(_scratch, name, buffer)
+    return buffer[:size]
+
+def detect_nonsilent_ranges(samples, frame_rate:int, max_amplitude:float, silence_thresh:float, min_silence_len:int=1000, seek_step:int=1) -> list:
+    # Vectorized equivalent of pydub.silence.detect_nonsilent: samples is a (frames, channels) array
+    # and the returned [start, end] ranges are in ms, exactly like pydub's
+    n_frames = samples.shape[0]
+    seg_len = int(round(1000 * n_frames / frame_rate))
+    if seg_len < min_silence_len:
+        return [[0, seg_len]]
+
+    # Cumulative sum of the per-frame energy (squares summed over the channels), so that the energy of any window
+    # is a single subtraction. Summing the channels first makes the buffer channels times smaller than one value
+    # per sample, and einsum does it in one pass without materializing the squared samples
+    # (exact integers for 16 bit audio, the squares of wider samples would overflow int64)
+    acc_dtype = np.int64 if samples.itemsize <= 2 else np.float64
+    energy = _scratch_buffer("energy", n_frames, acc_dtype)
+    csq = _scratch_buffer("csq", n_frames + 1, acc_dtype)
+    np.einsum('ij,ij->i', samples, samples, dtype=acc_dtype, out=energy)
+    csq[0] = 0
+    np.cumsum(energy, out=csq[1:])
+
+    starts = _window_starts(seg_len, min_silence_len, seek_step)
+    first = np.minimum((starts * (frame_rate / 1000.0)).astype(np.int64), n_frames)
+    last = np.minimum(((starts + min_silence_len) * (frame_rate / 1000.0)).astype(np.int64), n_frames)
+    return _nonsilent_ranges(starts, csq[last] - csq[first], (last - first) * samples.shape[1], seg_len, max_amplitude, silence_thresh, min_silence_len, seek_step)
+
+def _window_starts(seg_len:int, min_silence_len:int, seek_step:int) -> np.ndarray:
+    # Same windows as pydub: one every seek_step ms, plus the last one if the step does not land on it
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+    return starts
+
+def _nonsilent_ranges(starts, window_energy, window_count, seg_len:int, max_amplitude:float, silence_thresh:float, min_silence_len:int, seek_step:int) -> list:
+    # RMS of every window, truncated to an integer like audioop.rms does
+    rms = np.floor(np.sqrt(window_energy / np.maximum(window_count, 1)))
+    silent_ranges = _silent_ranges(starts, rms <= 10 ** (silence_thresh / 20) * max_amplitude, seek_step, min_silence_len)
+    if len(silent_ranges) == 0:
+        return [[0, seg_len]]
+    if silent_ranges[0, 0] == 0 and silent_ranges[0, 1] == seg_len:
+        return []
+
+    nonsilent_ranges = []
+    prev_end = 0
+    for start, end in silent_ranges.tolist():
+        nonsilent_ranges.append([prev_end, start])
+        prev_end = end
+    if silent_ranges[-1, 1] != seg_len:
+        nonsilent_ranges.append([prev_end, seg_len])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+def split_on_silence_ranges(nonsilent_ranges:list, seg_len:int, keep_silence:int=100) -> list:
+    # Same ranges as the chunks returned by pydub.silence.split_on_silence: keep_silence ms are kept
+    # around every non silent range and overlapping ranges are split in their middle
+    output_ranges = [[start - keep_silence, end + keep_silence] for start, end in nonsilent_ranges]
+    for range_i, range_ii in zip(output_ranges, output_ranges[1:]):
+        if range_ii[0] < range_i[1]:
+            range_i[1] = (range_i[1] + range_ii[0]) // 2
+            range_ii[0] = range_i[1]
+    return [[max(start, 0), min(end, seg_len)] for start, end in output_ranges]
+
+FFMPEG_PCM_FORMATS = {1: "u8", 2: "s16le", 4: "s32le"}
+
+def export_with_ffmpeg(audio:AudioSegment, output_path:str, audio_format:str, chunk_size:int=1 << 20):
+    # Streams the raw samples to ffmpeg's stdin, where AudioSegment.export would first write them
+    # to a temporary wav file and then have ffmpeg encode it to another temporary file
+    proc = subprocess.Popen(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                             "-f", FFMPEG_PCM_FORMATS[audio.sample_width], "-ar", str(audio.frame_rate), "-ac", str(audio.channels), "-i", "pipe:0",
+                             "-f", audio_format, output_path], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    raw_data = memoryview(audio.raw_data) # Slicing the memoryview does not copy the data
+    for offset in range(0, len(raw_data), chunk_size):
+        proc.stdin.write(raw_data[offset:offset + chunk_size])
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {output_path}: {proc.stderr.read().decode(errors='replace')}")
+
+def _default_seek_step(min_silence_len:int, keep_silence:int) -> int:
+    # Silences are only looked for every seek_step ms, so the boundaries are quantized to seek_step ms. By default
+    # the step scales with the other durations, which are much coarser than pydub's default of 1ms
+    return max(1, min(10, keep_silence // 2, min_silence_len // 50))
+
+STREAMING_MIN_DURATION = 600 # Files longer than this (in seconds) are trimmed block by block instead of being loaded whole
+
+def trim_audio_file_streaming(input_path:str, output_path:str, threshold:int, min_silence_len:int=1000, keep_silence:int=100, seek_step:int=None, block_duration:int=60):
+    # Trims a file soundfile can read in two passes over blocks of block_duration seconds, so that only a block and
+    # the energy of every ms are held in memory: the first pass finds the silences, the second copies the kept ranges.
+    # The ranges are exactly the ones detect_nonsilent_ranges finds, since its windows are made of whole ms
+    if seek_step is None:
+        seek_step = _default_seek_step(min_silence_len, keep_silence)
+
+    with sf.SoundFile(input_path) as src:
+        frame_rate, channels, n_frames = src.samplerate, src.channels, src.frames
+        dtype, max_amplitude = ('int16', 2 ** 15) if src.subtype == 'PCM_16' else ('int32', 2 ** 31)
+        blocksize = block_duration * frame_rate
+        length = int(round(1000 * n_frames / frame_rate))
+
+        if length < min_silence_len:
+            nonsilent_ranges = [[0, length]]
+        else:
+            # Cumulative energy at the first frame of every ms, filled in block by block
+            ms_frames = np.minimum((np.arange(length + 1) * (frame_rate / 1000.0)).astype(np.int64), n_frames)
+            envelope = np.zeros(length + 1, dtype=np.int64 if dtype == 'int16' else np.float64)
+            total, offset = 0, 0
+            for block in src.blocks(blocksize, dtype=dtype, always_2d=True):
+                csq = np.cumsum(np.einsum('ij,ij->i', block, block, dtype=envelope.dtype)) + total
+                lo, hi = np.searchsorted(ms_frames, [offset, offset + len(block)], side='right')
+                envelope[lo:hi] = csq[ms_frames[lo:hi] - offset - 1]
+                total, offset = csq[-1], offset + len(block)
+
+            starts = _window_starts(length, min_silence_len, seek_step)
+            ends = starts + min_silence_len
+            nonsilent_ranges = _nonsilent_ranges(starts, envelope[ends] - envelope[starts], (ms_frames[ends] - ms_frames[starts]) * channels,
+                                                 length, max_amplitude, threshold, min_silence_len, seek_step)
+
+        to_frame = lambda ms: min(int(ms * (frame_rate / 1000.0)), n_frames) # Same ms to frame conversion as pydub
+        frame_ranges = [(to_frame(start), to_frame(end)) for start, end in split_on_silence_ranges(nonsilent_ranges, length, keep_silence)]
+        n_trimmed = sum(end - start for start, end in frame_ranges)
+        # If data was trimmed, we add small 50ms silences before and after the signal 
+        padding = np.zeros((int(frame_rate * 0.05) if n_frames < n_trimmed else 0, channels), dtype=dtype)
+
+        with sf.SoundFile(output_path, 'w', frame_rate, channels, src.subtype, format=src.format) as dst:
+            dst.write(padding)
+            for start, end in frame_ranges:
+                src.seek(start)
+                for block in src.blocks(blocksize, frames=end - start, dtype=dtype, always_2d=True):
+                    dst.write(block)
+            dst.write(padding)
+
+    return length, int(round(1000 * (n_trimmed + 2 * len(padding)) / frame_rate))
+
+def load_audio(input_path:str, audio_format:str="wav"):
+    # Decoding stage: returns the (frames, channels) samples, their frame rate and maximum amplitude, and the
+    # AudioSegment they come from. 16 bit PCM wav files are read by soundfile straight into a NumPy array,
+    # without building any AudioSegment nor copying the audio into Python bytes objects.
+    # Returns None for the long files soundfile can read, which are left to trim_audio_file_streaming
+    try:
+        info = sf.info(input_path)
+    except RuntimeError:
+        info = None # Not readable by soundfile, left to pydub and ffmpeg
+    if info is not None and info.duration > STREAMING_MIN_DURATION:
+        return None
+
+    if audio_format.lower() == "wav" and info is not None and info.subtype == 'PCM_16':
+        samples, frame_rate = sf.read(input_path, dtype='int16', always_2d=True)
+        return samples, frame_rate, 2 ** 15, None
+
+    audio = AudioSegment.from_file(input_path, format=audio_format)
+    samples = np.frombuffer(audio.raw_data, dtype=audio.array_type).reshape(-1, audio.channels)
+    return samples, audio.frame_rate, audio.max_possible_amplitude, audio
 
-def trim_audio_file(input_wav:str, output_wav:str, threshold:int):
-    audio = AudioSegment.from_wav(input_wav)
+def trim_loaded_audio(loaded, threshold:int, min_silence_len:int=1000, keep_silence:int=100, seek_step:int=None):
+    # Detection stage: returns the original length in ms and the trimmed audio, as a NumPy array
+    # if the audio was read by soundfile or as an AudioSegment if it was decoded by pydub
+    samples, frame_rate, max_amplitude, audio = loaded
+    if seek_step is None:
+        seek_step = _default_seek_step(min_silence_len, keep_silence)
+    length = int(round(1000 * len(samples) / frame_rate))
+    nonsilent_ranges = detect_nonsilent_ranges(samples, frame_rate, max_amplitude, threshold, min_silence_len, seek_step)
+    kept_ranges = split_on_silence_ranges(nonsilent_ranges, length, keep_silence)
 
-    audio_segments = split_on_silence(audio, silence_thresh=threshold)
+    if audio is None:
+        to_frame = lambda ms: int(ms * (frame_rate / 1000.0)) # Same ms to frame conversion as pydub
+        trimmed = np.concatenate([samples[to_frame(start):to_frame(end)] for start, end in kept_ranges] or [samples[:0]])
+        if len(samples) < len(trimmed):
+            # If data was trimmed, we add small 50ms silences before and after the signal 
+            padding = np.zeros((int(frame_rate * 0.05), samples.shape[1]), dtype=samples.dtype)
+            trimmed = np.concatenate([padding, trimmed, padding])
+        return length, trimmed
 
-    trimmed_audio = AudioSegment.empty()
-    for segment in audio_segments:
-        trimmed_audio += segment
-        
+    # The kept ranges are copied straight from the decoded data into a buffer allocated once at its final size,
+    # without an AudioSegment (and a copy of its data) for every range. Frames missing at the very end are
+    # left as zeros, which is the silence pydub pads slices running past the data with
+    to_byte = lambda ms: int(ms * (frame_rate / 1000.0)) * audio.frame_width
+    byte_ranges = [(to_byte(start), to_byte(end)) for start, end in kept_ranges]
+    raw_data = memoryview(audio.raw_data)
+    trimmed_data = bytearray(sum(end - start for start, end in byte_ranges))
+    position = 0
+    for start, end in byte_ranges:
+        chunk = raw_data[start:end]
+        trimmed_data[position:position + len(chunk)] = chunk
+        position += end - start
+    trimmed_audio = audio._spawn(trimmed_data)
     if len(audio) < len(trimmed_audio):
         # If data was trimmed, we add small 50ms silences before and after the signal 
         trimmed_audio = AudioSegment.silent(duration=50) + trimmed_audio + AudioSegment.silent(duration=50)
+    return len(audio), trimmed_audio
 
-    trimmed_audio.export(output_wav, format="wav")
-    
-    return len(audio), len(trimmed_audio)
+def save_trimmed_audio(trimmed, frame_rate:int, output_path:str, audio_format:str="wav") -> int:
+    # Encoding stage: writes the output of trim_loaded_audio and returns its length in ms
+    if isinstance(trimmed, np.ndarray):
+        sf.write(output_path, trimmed, frame_rate, 'PCM_16')
+        return int(round(1000 * len(trimmed) / frame_rate))
 
-def trim_and_replicate(src_dir, dst_dir, threshold:int):
+    if audio_format.lower() == "wav":
+        trimmed.export(output_path, format="wav") # pydub writes wav files itself, without ffmpeg
+    else:
+        export_with_ffmpeg(trimmed, output_path, audio_format)
+    return len(trimmed)
+
+def trim_audio_file(input_path:str, output_path:str, threshold:int, min_silence_len:int=1000, keep_silence:int=100, seek_step:int=None, audio_format:str="wav"):
+    loaded = load_audio(input_path, audio_format)
+    if loaded is None:
+        return trim_audio_file_streaming(input_path, output_path, threshold, min_silence_len, keep_silence, seek_step)
+    length, trimmed = trim_loaded_audio(loaded, threshold, min_silence_len, keep_silence, seek_step)
+    return length, save_trimmed_audio(trimmed, loaded[1], output_path, audio_format)
+
+def trim_audio_file_ffmpeg(input_path:str, output_path:str, threshold:int, min_silence_len:int=1000, keep_silence:int=100, stream_copy:bool=False):
+    # Same trimming as trim_audio_file, but the silences are found by ffmpeg's silencedetect filter
+    # and the kept ranges are cut by ffmpeg as well, so that the audio never goes through Python
+    # The length of the decoded audio is read from the progress report of the detection pass itself,
+    # which saves spawning an ffprobe process for every file
+    detection = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-progress", "pipe:1", "-i", input_path,
+                                "-af", f"silencedetect=noise={threshold}dB:d={min_silence_len / 1000}", "-f", "null", "-"],
+                               capture_output=True, text=True, check=True)
+    length = int(round(int(re.findall(r"out_time_us=(\d+)", detection.stdout)[-1]) / 1000))
+    silence_starts = [int(round(float(t) * 1000)) for t in re.findall(r"silence_start: (-?[\d.]+)", detection.stderr)]
+    silence_ends = [int(round(float(t) * 1000)) for t in re.findall(r"silence_end: (-?[\d.]+)", detection.stderr)]
+    silence_ends += [length] * (len(silence_starts) - len(silence_ends)) # A silence running until the end of the file has no end
+
+    nonsilent_ranges = []
+    prev_end = 0
+    for start, end in zip(silence_starts, silence_ends):
+        if start > prev_end:
+            nonsilent_ranges.append([prev_end, start])
+        prev_end = end
+    if prev_end < length:
+        nonsilent_ranges.append([prev_end, length])
+    kept_ranges = split_on_silence_ranges(nonsilent_ranges, length, keep_silence)
+
+    if stream_copy and kept_ranges:
+        # The kept ranges are copied packet by packet by the concat demuxer, without decoding nor re-encoding the audio.
+        # Much cheaper for compressed files and lossless, but the boundaries snap to the packets of the input
+        quoted_path = "file:" + os.path.abspath(input_path).replace("'", "'\\''")
+        manifest = "".join(f"file '{quoted_path}'\ninpoint {start / 1000}\noutpoint {end / 1000}\n" for start, end in kept_ranges)
+        subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", "pipe:0",
+                        "-c", "copy", output_path], input=manifest, text=True, check=True)
+        return length, sum(end - start for start, end in kept_ranges)
+
+    # atrim is sample accurate, unlike aselect which keeps or drops whole decoded frames
+    cuts = [f"[0:a]atrim=start={start / 1000}:end={end / 1000},asetpts=PTS-STARTPTS[a{i}]" for i, (start, end) in enumerate(kept_ranges)]
+    if cuts:
+        filter_graph = ";".join(cuts) + ";" + "".join(f"[a{i}]" for i in range(len(cuts))) + f"concat=n={len(cuts)}:v=0:a=1[out]"
+    else:
+        filter_graph = "[0:a]atrim=end=0[out]"
+    subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", input_path, "-filter_complex", filter_graph, "-map", "[out]", output_path],
+                   check=True)
+
+    return length, sum(end - start for start, end in kept_ranges)
+
+def _write_txt_report(dst_file_path:str, lenght:int, length_trimmed:int):
+    # Legacy report: a corresponding .txt file next to every trimmed file
+    txt_file_path = os.path.splitext(dst_file_path)[0] + ".txt"
+    with open(txt_file_path, 'w') as txt_file:
+        txt_file.write("lenght,trimmed_file,duration_trimmed_portion\n")
+        txt_file.write(f"{lenght},{length_trimmed},{lenght - length_trimmed}\n")
+
+def _mark_as_trimmed(src_file_path:str, dst_file_path:str):
+    # The target gets the modification time of its source once it is completely written, so that a later run can
+    # tell it is up to date, while a file left half written by an interrupted run still looks outdated
+    os.utime(dst_file_path, ns=(os.stat(dst_file_path).st_atime_ns, os.stat(src_file_path).st_mtime_ns))
+
+def _is_up_to_date(src_file_path:str, dst_file_path:str) -> bool:
+    try:
+        return os.stat(dst_file_path).st_mtime_ns == os.stat(src_file_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def _trim_one(task):
+    # Module level so that it can be pickled and sent to the worker processes
+    src_file_path, dst_file_path, threshold, backend, audio_format, txt_report, seek_step, stream_copy = task
     try:
+        if backend == "ffmpeg":
+            lenght, length_trimmed = trim_audio_file_ffmpeg(src_file_path, dst_file_path, threshold, stream_copy=stream_copy)
+        else:
+            lenght, length_trimmed = trim_audio_file(src_file_path, dst_file_path, threshold, seek_step=seek_step, audio_format=audio_format)
+        _mark_as_trimmed(src_file_path, dst_file_path)
+
+        if txt_report:
+            _write_txt_report(dst_file_path, lenght, length_trimmed)
+    except Exception as e:
+        return dst_file_path, None, None, f"{src_file_path}: {str(e)}"
+    return dst_file_path, lenght, length_trimmed, None
+
+def _trim_pipeline(tasks:list, queue_size:int=4) -> list:
+    # Trims a batch of files with the decoding, the detection and the encoding of different files overlapping:
+    # while a file is encoded, the next one is trimmed and the one after is decoded. Decoding and encoding
+    # are mostly file I/O and ffmpeg subprocesses, which release the GIL, so threads are enough to overlap them.
+    # The bounded queues keep the decoder from running too far ahead of the slower stages
+    decode_q = queue.Queue(maxsize=queue_size)
+    encode_q = queue.Queue(maxsize=queue_size)
+    results = []
+
+    def decode():
+        for task in tasks:
+            try:
+                decode_q.put((task, load_audio(task[0], task[4]), None))
+            except Exception as e:
+                decode_q.put((task, None, e))
+        decode_q.put(None)
+
+    def encode():
+        while (item := encode_q.get()) is not None:
+            (src_file_path, dst_file_path, _, _, audio_format, txt_report, _, _), frame_rate, lenght, trimmed, error = item
+            try:
+                if error is not None:
+                    raise error
+                length_trimmed = trimmed if isinstance(trimmed, int) else save_trimmed_audio(trimmed, frame_rate, dst_file_path, audio_format)
+                _mark_as_trimmed(src_file_path, dst_file_path)
+                if txt_report:
+                    _write_txt_report(dst_file_path, lenght, length_trimmed)
+                results.append((dst_file_path, lenght, length_trimmed, None))
+            except Exception as e:
+                results.append((dst_file_path, None, None, f"{src_file_path}: {str(e)}"))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        decoder = executor.submit(decode)
+        encoder = executor.submit(encode)
+        while (item := decode_q.get()) is not None:
+            task, loaded, error = item
+            lenght, trimmed = None, None
+            if error is None:
+                try:
+                    if loaded is None:
+                        # Long files are trimmed and written at once, the encoder only gets the trimmed length
+                        lenght, trimmed = trim_audio_file_streaming(task[0], task[1], task[2], seek_step=task[6])
+                    else:
+                        lenght, trimmed = trim_loaded_audio(loaded, task[2], seek_step=task[6])
+                except Exception as e:
+                    error = e
+            encode_q.put((task, loaded and loaded[1], lenght, trimmed, error))
+            del loaded, trimmed # Only the encoder holds on to the audio from now on
+        encode_q.put(None)
+        decoder.result()
+        encoder.result()
+    return results
+
+def _batched(iterable, size:int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def _walk_audio(src_dir:str, suffix:str):
+    # Lazily yields the audio files below src_dir. os.scandir entries already know whether they are directories,
+    # so unlike os.walk nothing is stat'ed nor listed up front and the processing can start right away
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_audio(entry.path, suffix)
+            elif entry.name.lower().endswith(suffix):
+                yield entry.path
+
+def _mirror_directories(tasks):
+    # Creates every target directory once, in the main process and before its first file is sent to the workers,
+    # rather than calling os.makedirs for every single file
+    created_dirs = set()
+    for task in tasks:
+        task_dir = os.path.dirname(task[1])
+        if task_dir not in created_dirs:
+            os.makedirs(task_dir, exist_ok=True)
+            created_dirs.add(task_dir)
+        yield task
+
+def _trim_parameters(threshold:int, backend:str, seek_step:int, stream_copy:bool) -> str:
+    # Written in the report with every trimmed file, so that the files trimmed with other parameters are trimmed again
+    if backend == "ffmpeg":
+        return f"ffmpeg db={threshold} stream_copy={stream_copy}"
+    return f"numpy db={threshold} seek_step={seek_step}"
+
+def _skip_up_to_date(tasks, skipped:list, previous_rows:dict, parameters:str, dst_prefix_length:int):
+    # Files trimmed by a previous run with the same parameters are not trimmed again, which makes a rerun cheap.
+    # A file without a row in the report (e.g. trimmed by an interrupted run, which did not write it) is trimmed again
+    for task in tasks:
+        row = previous_rows.get(task[1][dst_prefix_length:])
+        if row is not None and row[4:] == [parameters] and _is_up_to_date(task[0], task[1]):
+            skipped.append(task[1])
+        else:
+            yield task
+
+def _read_report(report_path:str) -> dict:
+    if not os.path.exists(report_path):
+        return {}
+    with open(report_path, newline='') as report_file:
+        reader = csv.reader(report_file)
+        next(reader, None)
+        return {row[0]: row for row in reader}
+
+def trim_and_replicate(src_dir, dst_dir, threshold:int, max_workers:int=None, backend:str="numpy", audio_format:str="wav", txt_reports:bool=False, seek_step:int=None, stream_copy:bool=False, force:bool=False):
+    try:
+        report_path = os.path.join(dst_dir, "silence_report.csv")
+        previous_rows = {} if force else _read_report(report_path)
+        parameters = _trim_parameters(threshold, backend, seek_step, stream_copy)
+
         # Recursively create the same directory structure in the target directory
-        for root, _, files in os.walk(src_dir):
-            for file in files:
-                if not file.endswith(".wav"):
-                    continue
-                src_file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(src_file_path, src_dir)
-                dst_file_path = os.path.join(dst_dir, relative_path)
-
-                # Create the target directory if it doesn't exist
-                os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
-
-                lenght, length_trimmed = trim_audio_file(src_file_path, dst_file_path, threshold)
-
-                # Create a corresponding empty .txt file
-                txt_file_path = os.path.splitext(dst_file_path)[0] + ".txt"
-                
-                # Add annotations
-                with open(txt_file_path, 'w') as txt_file:
-                    txt_file.write("lenght,trimmed_file,duration_trimmed_portion\n")
-                    txt_file.write(f"{lenght},{length_trimmed},{lenght - length_trimmed}\n")
-
-        print(f"Directory structure and empty .txt files replicated from '{src_dir}' to '{dst_dir}'. All wav files have been trimmed.")
-        print("WARNING ! Although the directory structure was copied, ONLY THE WAV FILES were copied.")
+        suffix = "." + audio_format.lower()
+        prefix_length = len(os.path.join(src_dir, "")) # Relative paths are sliced out rather than computed by os.path.relpath
+        tasks = _mirror_directories(((src_file_path, os.path.join(dst_dir, src_file_path[prefix_length:]), threshold, backend, audio_format, txt_reports, seek_step, stream_copy)
+                                     for src_file_path in _walk_audio(src_dir, suffix)))
+        dst_prefix_length = len(os.path.join(dst_dir, ""))
+        skipped = []
+        if not force:
+            tasks = _skip_up_to_date(tasks, skipped, previous_rows, parameters, dst_prefix_length)
+
+        # Every file is trimmed independently, so they are spread over all the cores. With the NumPy backend,
+        # every process runs its own decode -> detect -> encode pipeline over batches of files
+        if backend == "ffmpeg":
+            results = process_map(_trim_one, tasks, max_workers=max_workers or os.cpu_count(), chunksize=8, total=None)
+        else:
+            results = [result for batch in process_map(_trim_pipeline, _batched(tasks, 8), max_workers=max_workers or os.cpu_count(), total=None) for result in batch]
+        errors = [error for _, _, _, error in results if error]
+        for error in errors:
+            print(f"Error: {error}")
+
+        # The durations of all the files are gathered in a single report instead of one small file per audio file
+        os.makedirs(dst_dir, exist_ok=True)
+        # The rows are gathered from the workers' results and written by a large buffer, then synced to disk once
+        with open(report_path, 'w', newline='', buffering=1 << 20) as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["path", "original_ms", "trimmed_ms", "removed_ms", "parameters"])
+            writer.writerows(previous_rows[dst_file_path[dst_prefix_length:]] for dst_file_path in skipped)
+            writer.writerows((dst_file_path[dst_prefix_length:], lenght, length_trimmed, lenght - length_trimmed, parameters)
+                             for dst_file_path, lenght, length_trimmed, error in results if not error)
+            report_file.flush()
+            os.fsync(report_file.fileno())
+
+        print(f"Directory structure replicated from '{src_dir}' to '{dst_dir}'. {len(results) - len(errors)} {audio_format} files have been trimmed, {len(errors)} failed, {len(skipped)} were already up to date. See '{report_path}' for the trimmed durations.")
+        print(f"WARNING ! Although the directory structure was copied, ONLY THE {audio_format.upper()} FILES were copied.")
     except Exception as e:
         print(f"Error: {str(e)}")
 
@@ -66,8 +509,15 @@ def trim_and_replicate(src_dir, dst_dir, threshold:int):
 @click.argument('src_directory', type=click.Path(exists=True))
 @click.argument('dst_directory', type=click.Path())
 @click.option('--db', type=NegativeNumberParamType(), default=-40, help='The desired loudness threshold in dB LUFS (Loudness Units Full Scale) to identify silent areas.')
-def trim_and_replicate_structure(src_directory, dst_directory, db):
-    trim_and_replicate(src_directory, dst_directory, db)
+@click.option('-j', '--jobs', type=click.INT, default=None, help='The number of files trimmed in parallel (defaults to the number of CPUs).')
+@click.option('-t', '--type', type=click.STRING, default="wav", help='The type of audio file to look for (flac, wav, etc).')
+@click.option('--txt-reports', is_flag=True, default=False, help='Also write the legacy .txt report next to every trimmed file.')
+@click.option('--seek-step', type=click.INT, default=None, help='The step (in ms) between two silence checks. Larger steps are faster but quantize the boundaries (defaults to 10ms).')
+@click.option('--backend', type=click.Choice(["numpy", "ffmpeg"]), default="numpy", help='Find the silences with NumPy or with the silencedetect filter of ffmpeg (faster on long compressed files, but the boundaries slightly differ).')
+@click.option('--stream-copy', is_flag=True, default=False, help='With the ffmpeg backend, copy the kept ranges without re-encoding them (lossless and much faster on compressed files, but the cuts snap to the packets of the input).')
+@click.option('--force', is_flag=True, default=False, help='Trim all the files again, including the ones already trimmed by a previous run.')
+def trim_and_replicate_structure(src_directory, dst_directory, db, jobs, type, txt_reports, seek_step, backend, stream_copy, force):
+    trim_and_replicate(src_directory, dst_directory, db, jobs, backend, type, txt_reports, seek_step, stream_copy, force)
 
 if __name__ == '__main__':
     trim_and_replicate_structure()